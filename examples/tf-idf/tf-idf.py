@@ -28,9 +28,6 @@ def count_docs_folder(line, initial):
     return {'docs_count' : initial['docs_count'] + 1}
 
 
-def unique_words_reducer(table):
-    yield table[0]
-
 def calc_idf_reducer(table):
     docs_n = 0
     for line in table:
@@ -82,8 +79,7 @@ count_docs.finalize()
 
 
 count_idf = mrop.ComputeGraph(source=split_word)
-count_idf.sort(('doc_id', 'word'))
-count_idf.reduce(unique_words_reducer, keys=('doc_id', 'word'))
+count_idf.distinct(keys=('doc_id', 'word'))
 count_idf.join(on=count_docs, keys=tuple(), strategy='outer')
 count_idf.sort(('word',))
 count_idf.reduce(calc_idf_reducer, keys=('word',))
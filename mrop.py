@@ -1,5 +1,31 @@
+import array
+import bz2
+import collections
+import concurrent.futures
+import copy
+import dis
+import glob
+import heapq
+import gzip
+import hashlib
+import itertools
+import functools
 import json
+import lzma
+import math
+import mmap
+import operator
+import os
+import pickle
+import queue
+import re
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import warnings
 """compute-graph by Antonenko Daniil (May 2018)
 
 The module implements operations over tables, each line represented by a json-like structure.
@@ -11,6 +37,1393 @@ class ComputeGraphError(Exception):
     pass
 
 
+JOIN_STRATEGIES = ('inner', 'left', 'right', 'outer')
+
+# A side of a join with at most this many rows is loaded into memory whole and the other side
+# is streamed through it (broadcast join) instead of sorting and grouping both sides.
+BROADCAST_JOIN_ROWS = 10000
+
+# A join never keeps more than JOIN_MEMORY_ROWS rows of a side in memory. Larger inputs are joined by
+# grace hash join: both sides are hash partitioned into GRACE_JOIN_BUCKETS files on disk and joined bucket
+# by bucket, oversized buckets are partitioned again, up to GRACE_JOIN_MAX_DEPTH times.
+JOIN_MEMORY_ROWS = 1000000
+JOIN_MEMORY_BYTES = 1 << 30
+GRACE_JOIN_BUCKETS = 16
+GRACE_JOIN_MAX_BUCKETS = 256
+GRACE_JOIN_MAX_DEPTH = 4
+SPILL_BATCH_LINES = 1024
+
+# Parallel fold folds chunks of PARALLEL_FOLD_CHUNK_LINES lines in worker processes
+PARALLEL_FOLD_CHUNK_LINES = 10000
+
+# Distinct keeps at most DISTINCT_MEMORY_ROWS keys in memory. The rest of the table is hash partitioned into
+# DISTINCT_SPILL_BUCKETS files on disk and each file is deduplicated separately, up to DISTINCT_MAX_DEPTH times
+DISTINCT_MEMORY_ROWS = 1000000
+DISTINCT_SPILL_BUCKETS = 16
+DISTINCT_MAX_DEPTH = 4
+
+# Parallel sort splits tables of at least PARALLEL_SORT_MIN_LINES lines into PARALLEL_SORT_CHUNKS_PER_WORKER
+# chunks per worker process
+PARALLEL_SORT_MIN_LINES = 100000
+PARALLEL_SORT_CHUNKS_PER_WORKER = 2
+
+# Pipelined stages pass rows downstream in batches of PIPELINE_BATCH_LINES through queues of at most
+# PIPELINE_QUEUE_BATCHES batches
+PIPELINE_BATCH_LINES = 256
+PIPELINE_QUEUE_BATCHES = 16
+
+# Memoized mappers keep outputs for at most MEMOIZE_SIZE different inputs
+MEMOIZE_SIZE = 65536
+
+# Tracing with memory attribution takes tracemalloc snapshots at least TRACE_MEMORY_INTERVAL seconds apart,
+# and at least TRACE_MEMORY_OVERHEAD times the duration of the previous snapshot apart, since a snapshot takes
+# time proportional to the number of live objects. TRACE_MEMORY_FRAMES frames of each allocation are kept to
+# find the operation it belongs to
+TRACE_MEMORY_INTERVAL = 1.0
+TRACE_MEMORY_OVERHEAD = 10
+TRACE_MEMORY_FRAMES = 16
+
+# Statistics keep a sketch of STATISTICS_SKETCH_SIZE minimal hashes of keys to estimate number of distinct keys,
+# and measure pickled size of every STATISTICS_SAMPLE_EVERY-th line
+STATISTICS_SKETCH_SIZE = 256
+STATISTICS_SAMPLE_EVERY = 64
+# Cost of building a hash table from a line relative to probing it with a line
+HASH_JOIN_BUILD_COST = 3
+
+# Share of false positives of the Bloom filters built for semi-join filtering
+BLOOM_FILTER_ERROR_RATE = 0.01
+
+COMPRESSED_OPENERS = {'gzip' : gzip.open, 'bz2' : bz2.open, 'xz' : lzma.open}
+COMPRESSED_EXTENSIONS = {'.gz' : 'gzip', '.bz2' : 'bz2', '.xz' : 'xz', '.lzma' : 'xz'}
+COMPRESSED_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'))
+
+# Compressed files are decompressed by a background thread, which hands lines to the parser
+# in batches of READ_BATCH_LINES through a queue of at most READ_QUEUE_BATCHES batches.
+READ_BATCH_LINES = 1024
+READ_QUEUE_BATCHES = 16
+
+
+def detect_compression(filename, mode='r'):
+    """Return compression of the file ('gzip', 'bz2', 'xz') or None for plain text.
+    Looks at the extension, and when reading, at the magic bytes of the file."""
+    for extension, compression in COMPRESSED_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    if 'r' in mode:
+        with open(filename, 'rb') as file:
+            head = file.read(6)
+        for magic, compression in COMPRESSED_MAGIC:
+            if head.startswith(magic):
+                return compression
+    return None
+
+
+def open_file(filename, mode='r'):
+    """Open a text file, transparently (de)compressing it if needed"""
+    compression = detect_compression(filename, mode)
+    if compression is None:
+        return open(filename, mode)
+    return COMPRESSED_OPENERS[compression](filename, mode + 't')
+
+
+def _background_lines(file):
+    """Read lines of the file in a separate thread, so that decompression overlaps with their processing"""
+    batches = queue.Queue(maxsize=READ_QUEUE_BATCHES)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        try:
+            while not stopped.is_set():
+                batch = list(itertools.islice(file, READ_BATCH_LINES))
+                if not batch:
+                    break
+                put(batch)
+            put(done)
+        except BaseException as error:
+            put(error)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is done:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def expand_source_files(source):
+    """Turn a filename, a directory, a glob pattern or a list of them into a list of files. An existing file
+    is taken as it is, even if its name looks like a pattern. Returns None if source does not describe files."""
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return sorted(
+                os.path.join(source, name) for name in os.listdir(source)
+                if not name.startswith('.') and os.path.isfile(os.path.join(source, name))
+            )
+        if glob.has_magic(source) and not os.path.exists(source):
+            return sorted(glob.glob(source))
+        return [source]
+    if isinstance(source, (list, tuple)) and source and all(isinstance(item, str) for item in source):
+        return [filename for item in source for filename in expand_source_files(item)]
+    return None
+
+
+# Checkpoints are gzip-compressed streams of pickled batches of CHECKPOINT_BATCH_LINES rows
+CHECKPOINT_BATCH_LINES = 1024
+CHECKPOINT_OPERATIONS = ('_sort', '_join')
+
+
+class _Unfingerprintable(Exception):
+    """The object has no stable fingerprint (e.g. a generator source)"""
+    pass
+
+
+def _global_names(code):
+    """Names that the code and the code nested in it may look up in globals"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _fingerprint(obj, graph_fingerprints=None):
+    """Stable across runs hex digest of the object. Functions are identified by their code, closure and the
+    globals they refer to, so that changing a helper called by a mapper changes the fingerprint too.
+    Graphs are identified by the fingerprint of their result, taken from graph_fingerprints if given
+    (a function of the graph returning its stage fingerprints or None)."""
+    digest = hashlib.sha1()
+    functions = {}
+
+    def feed(obj):
+        if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+            digest.update(repr((type(obj).__name__, obj)).encode())
+        elif isinstance(obj, (list, tuple)):
+            digest.update('{}({}'.format(type(obj).__name__, len(obj)).encode())
+            for item in obj:
+                feed(item)
+        elif isinstance(obj, (set, frozenset)):
+            digest.update('{}({}'.format(type(obj).__name__, len(obj)).encode())
+            for item in sorted(_fingerprint(item, graph_fingerprints) for item in obj):
+                digest.update(item.encode())
+        elif isinstance(obj, re.Pattern):
+            feed(('re.Pattern', obj.pattern, obj.flags))
+        elif isinstance(obj, dict):
+            digest.update('dict({}'.format(len(obj)).encode())
+            for key, value in sorted(obj.items(), key=lambda item: repr(item[0])):
+                feed(key)
+                feed(value)
+        elif isinstance(obj, ComputeGraph):
+            fingerprints = (graph_fingerprints or ComputeGraph._stage_fingerprints)(obj)
+            if fingerprints is None:
+                raise _Unfingerprintable(obj)
+            feed(fingerprints[-1])
+        elif isinstance(obj, JsonLinesIndex):
+            feed((os.path.abspath(obj.filename), obj.keys, obj._file_state()))
+        elif isinstance(obj, ColumnarTable):
+            schema = os.stat(os.path.join(obj.dirname, COLUMNAR_SCHEMA))
+            feed((os.path.abspath(obj.dirname), obj.columns, schema.st_size, schema.st_mtime_ns))
+        elif isinstance(obj, Memoizer):
+            feed((obj.fields, obj.passthrough))
+        elif isinstance(obj, types.CodeType):
+            feed((obj.co_code, obj.co_names, obj.co_varnames, obj.co_consts))
+        elif isinstance(obj, types.FunctionType):
+            if id(obj) in functions:
+                digest.update('function#{}'.format(functions[id(obj)]).encode())
+                return
+            functions[id(obj)] = len(functions)
+            names = sorted(name for name in _global_names(obj.__code__) if name in obj.__globals__)
+            feed((obj.__module__, obj.__qualname__, obj.__code__, obj.__defaults__,
+                  [cell.cell_contents for cell in obj.__closure__ or ()],
+                  [(name, obj.__globals__[name]) for name in names]))
+        elif isinstance(obj, (types.BuiltinFunctionType, type)):
+            feed((obj.__module__, obj.__qualname__))
+        elif isinstance(obj, types.ModuleType):
+            digest.update('module {}'.format(obj.__name__).encode())
+        else:
+            raise _Unfingerprintable(obj)
+
+    feed(obj)
+    return digest.hexdigest()
+
+
+def _read_checkpoint(filename):
+    """Rows of a checkpoint written by ComputeGraph._checkpointed"""
+    with gzip.open(filename, 'rb') as file:
+        while True:
+            try:
+                yield from pickle.load(file)
+            except EOFError:
+                return
+
+
+def _read_spill(filename):
+    """Rows of a file written by _spill"""
+    with open(filename, 'rb') as file:
+        while True:
+            try:
+                yield from pickle.load(file)
+            except EOFError:
+                return
+
+
+def _spill(table, bucket_of, n_buckets, directory, prefix):
+    """Write rows of the table to n_buckets files in directory, choosing bucket of each row by bucket_of.
+    Returns filenames, number of rows in each bucket and fields of the first row (None for an empty table)."""
+    filenames = [os.path.join(directory, '{}-{}'.format(prefix, i)) for i in range(n_buckets)]
+    files = [open(filename, 'wb') for filename in filenames]
+    buffers = [[] for _ in range(n_buckets)]
+    counts = [0] * n_buckets
+    fields = None
+    try:
+        for line in table:
+            if fields is None:
+                fields = set(line.keys())
+            bucket = bucket_of(line)
+            buffers[bucket].append(line)
+            counts[bucket] += 1
+            if len(buffers[bucket]) >= SPILL_BATCH_LINES:
+                pickle.dump(buffers[bucket], files[bucket], protocol=pickle.HIGHEST_PROTOCOL)
+                buffers[bucket] = []
+        for file, buffer in zip(files, buffers):
+            if buffer:
+                pickle.dump(buffer, file, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for file in files:
+            file.close()
+    return filenames, counts, fields
+
+
+def _key_function(keys):
+    """Function returning values of keys of a line, ordered the same way as tuples of them"""
+    if not keys:
+        return lambda line: ()
+    if len(keys) == 1:
+        return operator.itemgetter(keys[0])
+    return operator.itemgetter(*keys)
+
+
+class _UnhashableKey(str):
+    """Json of values of keys that can not be hashed, equal only to the same json of such values"""
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is _UnhashableKey and str.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = str.__hash__
+
+
+def _distinct_key_function(keys):
+    """Function returning a hashable key of a line for distinct: values of keys (their json if they can not
+    be hashed), or the whole line if keys are not given"""
+    if not keys:
+        return lambda line: json.dumps(line, sort_keys=True, default=repr)
+    key = _key_function(keys)
+
+    def hashable_key(line):
+        value = key(line)
+        try:
+            hash(value)
+        except TypeError:
+            return _UnhashableKey(json.dumps(value, sort_keys=True, default=repr))
+        return value
+    return hashable_key
+
+
+def _sort_chunk(values, start):
+    """Sort a chunk of values of keys of a table starting at the index start, returning the indices
+    of its lines in the sorted order. Runs in sorting processes."""
+    return [start + i for i in sorted(range(len(values)), key=values.__getitem__)]
+
+
+def _parse_lines(lines):
+    """Parse json lines into rows"""
+    for line in lines:
+        yield json.loads(line)
+
+
+def _fold_chunk(chunk, folder, initial):
+    """Fold a chunk of a table starting from initial. Runs in folding and reader processes."""
+    for line in chunk:
+        initial = folder(line, initial)
+    return initial
+
+
+def _tree_merge(states, merge, initial):
+    """Merge partial states of a fold pairwise, level by level, keeping their order. initial if there are none."""
+    states = list(states)
+    if not states:
+        return initial
+    while len(states) > 1:
+        merged = [merge(left, right) for left, right in zip(states[0::2], states[1::2])]
+        if len(states) % 2:
+            merged.append(states[-1])
+        states = merged
+    return states[0]
+
+
+def _read_partition(filename, mappers=(), fold=None):
+    """Read one file of a partitioned source and apply mappers to its rows. Runs in reader processes.
+    If fold (folder, initial) is given, the rows are folded and the list of the only state is returned."""
+    with open_file(filename) as file:
+        table = _parse_lines(file)
+        for mapper in mappers:
+            table = (output for line in table for output in mapper(line))
+        if fold is not None:
+            return [_fold_chunk(table, *fold)]
+        return list(table)
+
+
+class JsonLinesIndex(object):
+    """
+    Persistent index of a json lines file: values of keys -> byte offsets of the lines with them.
+    The index is stored in a sidecar file next to the indexed one and rebuilt when the file changes.
+
+    Passed as 'on' to ComputeGraph.join, it lets the join parse only the lines matching the table:
+
+        graph_data = mrop.build_index('graph_data.txt', ('edge_id',))
+        average_velocity.join(on=graph_data, keys=('edge_id',), strategy='inner')
+    """
+
+    def __init__(self, filename, keys):
+        """
+        Keyword arguments:
+        filename    -- uncompressed json lines file to index
+        keys        -- tuple of keys to index the lines by
+        """
+        if not keys:
+            raise ComputeGraphError('Index needs at least one key')
+        if detect_compression(filename) is not None:
+            raise ComputeGraphError('Only uncompressed files can be indexed')
+        self.filename = filename
+        self.keys = tuple(keys)
+        self.index_filename = '{}.{}.index'.format(filename, '+'.join(self.keys))
+        self.offsets = None
+
+    def _file_state(self):
+        stat = os.stat(self.filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_valid(self):
+        """Whether the sidecar exists and was built for the current state of the file"""
+        try:
+            with open(self.index_filename, 'rb') as file:
+                return pickle.load(file) == (self.keys, self._file_state())
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+    def build(self):
+        """Scan the file and save the index to the sidecar"""
+        state = self._file_state()
+        offsets = {}
+        with open(self.filename, 'rb') as file:
+            offset = 0
+            for line in file:
+                if line.strip():
+                    parsed = json.loads(line)
+                    offsets.setdefault(tuple(parsed[k] for k in self.keys), []).append(offset)
+                offset += len(line)
+        temporary = '{}.{}.tmp'.format(self.index_filename, threading.get_ident())
+        with open(temporary, 'wb') as file:
+            pickle.dump((self.keys, state), file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(offsets, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.index_filename)
+        self.offsets = offsets
+        return self
+
+    def load(self):
+        """Load the index from the sidecar, rebuilding it if the file has changed"""
+        if not self.is_valid():
+            return self.build()
+        with open(self.index_filename, 'rb') as file:
+            pickle.load(file)
+            self.offsets = pickle.load(file)
+        return self
+
+    def lines(self, keys_values, file):
+        """Parsed lines with the given tuple of values of keys, read from the opened binary file"""
+        lines = []
+        for offset in self.offsets.get(keys_values, ()):
+            file.seek(offset)
+            lines.append(json.loads(file.readline()))
+        return lines
+
+    def __iter__(self):
+        """All lines of the file"""
+        with open(self.filename) as file:
+            yield from _parse_lines(line for line in file if line.strip())
+
+
+def build_index(filename, keys):
+    """Index json lines file by keys, reusing the sidecar index if the file has not changed"""
+    return JsonLinesIndex(filename, keys).load()
+
+
+COLUMNAR_SCHEMA = 'schema.json'
+# String columns with at most this share of distinct values are dictionary encoded
+COLUMNAR_DICTIONARY_RATIO = 0.5
+# Presence of a column in a row: the key is absent, holds a value or holds None
+COLUMNAR_ABSENT, COLUMNAR_VALUE, COLUMNAR_NONE = 0, 1, 2
+COLUMNAR_TYPECODES = {'int64' : 'q', 'float64' : 'd', 'bool' : 'B'}
+
+
+def _column_type(values):
+    """Storage type for the values (not None) of a column"""
+    types = {type(value) for value in values}
+    if types == {bool}:
+        return 'bool'
+    if types == {int} and all(-2 ** 63 <= value < 2 ** 63 for value in values):
+        return 'int64'
+    if types == {float}:
+        return 'float64'
+    if types == {str}:
+        if len(set(values)) <= COLUMNAR_DICTIONARY_RATIO * len(values):
+            return 'dictionary'
+        return 'string'
+    return 'json'
+
+
+def _write_strings(strings, filename):
+    """Write strings as utf-8 blob filename.data and int64 offsets of their ends filename.offsets"""
+    offsets = array.array('q', [0])
+    with open(filename + '.data', 'wb') as file:
+        for string in strings:
+            data = string.encode()
+            file.write(data)
+            offsets.append(offsets[-1] + len(data))
+    with open(filename + '.offsets', 'wb') as file:
+        offsets.tofile(file)
+
+
+def write_columnar(table, dirname):
+    """Save the table to dirname in the columnar format read by ColumnarTable:
+    presence of the column in each row and the values for each column, in fixed width arrays if possible"""
+    columns = {}
+    n_rows = 0
+    for line in table:
+        for name, value in line.items():
+            if name not in columns:
+                columns[name] = [None] * n_rows, bytearray(n_rows)
+            columns[name][0].append(value)
+            columns[name][1].append(COLUMNAR_NONE if value is None else COLUMNAR_VALUE)
+        n_rows += 1
+        for values, presence in columns.values():
+            if len(presence) < n_rows:
+                values.append(None)
+                presence.append(COLUMNAR_ABSENT)
+
+    os.makedirs(dirname, exist_ok=True)
+    schema = {'rows' : n_rows, 'columns' : []}
+    for i, (name, (values, presence)) in enumerate(columns.items()):
+        filename = os.path.join(dirname, str(i))
+        present = [value for value in values if value is not None]
+        column_type = _column_type(present)
+        with open(filename + '.presence', 'wb') as file:
+            file.write(presence)
+        if column_type in COLUMNAR_TYPECODES:
+            with open(filename + '.values', 'wb') as file:
+                array.array(COLUMNAR_TYPECODES[column_type],
+                            (0 if value is None else value for value in values)).tofile(file)
+        elif column_type == 'dictionary':
+            dictionary = sorted(set(present))
+            codes = {string : code for code, string in enumerate(dictionary)}
+            with open(filename + '.values', 'wb') as file:
+                array.array('i', (0 if value is None else codes[value] for value in values)).tofile(file)
+            _write_strings(dictionary, filename + '.dictionary')
+        elif column_type == 'string':
+            _write_strings(('' if value is None else value for value in values), filename)
+        else:
+            _write_strings(('' if value is None else json.dumps(value) for value in values), filename)
+        schema['columns'].append({'name' : name, 'type' : column_type, 'file' : str(i)})
+
+    with open(os.path.join(dirname, COLUMNAR_SCHEMA), 'w') as file:
+        json.dump(schema, file)
+
+
+def is_columnar(dirname):
+    """Whether dirname holds a table written by write_columnar"""
+    return os.path.isfile(os.path.join(dirname, COLUMNAR_SCHEMA))
+
+
+class _MappedFiles(object):
+    """Memory mapped files of a column, released all together"""
+
+    def __init__(self):
+        self.files = []
+        self.maps = []
+        self.views = []
+
+    def view(self, filename, typecode='B'):
+        """Memoryview of the whole file, as an array of typecode items"""
+        file = open(filename, 'rb')
+        self.files.append(file)
+        if not os.fstat(file.fileno()).st_size:
+            return memoryview(array.array(typecode))
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        view = memoryview(mapped).cast(typecode)
+        self.views.append(view)
+        return view
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        for mapped in self.maps:
+            mapped.close()
+        for file in self.files:
+            file.close()
+
+
+class ColumnarTable(object):
+    """
+    Table saved by write_columnar (or ComputeGraph.save_columnar), used as a source of a graph.
+    Columns are memory mapped, not read: numbers are taken from the mapped arrays directly and
+    only the columns asked for are touched at all.
+
+        velocities = mrop.ComputeGraph(source=mrop.ColumnarTable('travel_times', columns=('edge_id', 'speed')))
+    """
+
+    def __init__(self, dirname, columns=None):
+        """
+        Keyword arguments:
+        dirname     -- directory with the table
+        columns     -- None or tuple of names of columns to read (default: all columns)
+        """
+        self.dirname = dirname
+        with open(os.path.join(dirname, COLUMNAR_SCHEMA)) as file:
+            self.schema = json.load(file)
+        names = [column['name'] for column in self.schema['columns']]
+        unknown = set(columns or ()) - set(names)
+        if unknown:
+            raise ComputeGraphError('No columns {} in {}'.format(sorted(unknown), dirname))
+        self.columns = tuple(names if columns is None else columns)
+
+    def __len__(self):
+        return self.schema['rows']
+
+    def _reader(self, column, files):
+        """Function of row number returning the value of the column in the row"""
+        filename = os.path.join(self.dirname, column['file'])
+        column_type = column['type']
+        if column_type in COLUMNAR_TYPECODES:
+            values = files.view(filename + '.values', COLUMNAR_TYPECODES[column_type])
+            if column_type == 'bool':
+                return lambda i: bool(values[i])
+            return values.__getitem__
+        if column_type == 'dictionary':
+            codes = files.view(filename + '.values', 'i')
+            offsets = files.view(filename + '.dictionary.offsets', 'q')
+            data = files.view(filename + '.dictionary.data')
+            dictionary = [str(data[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+            return lambda i: dictionary[codes[i]]
+        offsets = files.view(filename + '.offsets', 'q')
+        data = files.view(filename + '.data')
+        if column_type == 'string':
+            return lambda i: str(data[offsets[i]:offsets[i + 1]], 'utf-8')
+        return lambda i: json.loads(str(data[offsets[i]:offsets[i + 1]], 'utf-8'))
+
+    def __iter__(self):
+        files = _MappedFiles()
+        try:
+            by_name = {column['name'] : column for column in self.schema['columns']}
+            readers = []
+            for name in self.columns:
+                presence = files.view(os.path.join(self.dirname, by_name[name]['file'] + '.presence'))
+                readers.append((name, presence, self._reader(by_name[name], files)))
+            for i in range(self.schema['rows']):
+                line = {}
+                for name, presence, reader in readers:
+                    if presence[i] == COLUMNAR_VALUE:
+                        line[name] = reader(i)
+                    elif presence[i] == COLUMNAR_NONE:
+                        line[name] = None
+                yield line
+        finally:
+            readers = None
+            files.close()
+
+
+class BloomFilter(object):
+    """Set of values that may answer 'contains' wrongly for absent values with probability error_rate.
+    Values are hashed with hash(), so a filter should not leave the process it was built in."""
+
+    def __init__(self, capacity, error_rate=None):
+        error_rate = error_rate or BLOOM_FILTER_ERROR_RATE
+        capacity = max(capacity, 1)
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, value):
+        first = hash((value,))
+        second = hash((value, 'second')) | 1
+        return ((first + i * second) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class _SemiJoin(object):
+    """Side 'on' of a join with a Bloom filter over its keys. The filter is pushed into the table pipeline
+    below its sorts, so that table lines without a match are dropped before being sorted and joined.
+    'on' is read once, when either the filter or the join needs it. Unless it is already in memory, it is
+    spilled to a temporary file on the way, and the filter and the join read it from there."""
+
+    def __init__(self, context, on, keys):
+        self.context = context
+        self.on = on
+        self.keys = keys
+        self.lines = None
+        self.directory = None
+        self.filename = None
+        self.count = None
+        self.bloom = None
+        self.table_fields = None
+        self.passed = 0
+
+    def _prepare(self):
+        if self.bloom is not None:
+            return
+        lines = self.on.result if isinstance(self.on, ComputeGraph) and self.on.result else self.on
+        if isinstance(lines, (list, tuple)):
+            self.lines, self.count = lines, len(lines)
+        else:
+            self.directory = tempfile.TemporaryDirectory(prefix='mrop-semi-join-')
+            filenames, counts, _ = _spill(self.context.rows(lines), lambda line: 0, 1, self.directory.name, 'on')
+            self.filename, self.count = filenames[0], counts[0]
+        self.bloom = BloomFilter(self.count)
+        key = _key_function(self.keys)
+        for line in self:
+            self.bloom.add(key(line))
+        self.context.print('_SemiJoin built Bloom filter over {} lines of {}'.format(self.count, self.on))
+
+    def filter(self, table):
+        """Lines of the table that may have a match in 'on'. Fields of the first line are kept for fill"""
+        self._prepare()
+        key = _key_function(self.keys)
+        bloom = self.bloom
+        dropped = 0
+        for line in table:
+            if self.table_fields is None:
+                self.table_fields = set(line.keys())
+            if key(line) in bloom:
+                self.passed += 1
+                yield line
+            else:
+                dropped += 1
+        self.context.print('_SemiJoin passed {} lines and dropped {}'.format(self.passed, dropped))
+
+    def fill(self, joined):
+        """Lines of the join, with fields of the table filled with None if the filter dropped the whole table.
+        The join does not know those fields then, and every line of a right join is an unmatched line of 'on'.
+        Joins read the table before yielding unmatched lines of 'on', so the filter is done by then."""
+        for line in joined:
+            if not self.passed and self.table_fields:
+                line = {**line, **{field : None for field in self.table_fields - line.keys()}}
+            yield line
+
+    def __len__(self):
+        self._prepare()
+        return self.count
+
+    def __iter__(self):
+        self._prepare()
+        if self.filename is None:
+            return iter(self.lines)
+        return _read_spill(self.filename)
+
+
+class Statistics(object):
+    """
+    Statistics of the stages of graphs (the table after the source and after each operation): number of rows,
+    average size of a row in bytes and estimates of the number of distinct values of the keys used by the next
+    operation. Stages are identified by their fingerprints, so statistics saved to a file in one run are
+    used to plan joins in the next ones.
+    """
+
+    def __init__(self, filename=None):
+        """
+        Keyword arguments:
+        filename    -- None or json file to load statistics from and to save them to
+        """
+        self.filename = filename
+        self.stages = {}
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename) as file:
+                self.stages = json.load(file)
+
+    def get(self, stage):
+        """Statistics of the stage: dict with 'rows', 'row_bytes' and 'distinct' (by json list of keys)"""
+        return self.stages.get(stage)
+
+    def distinct(self, stage, keys):
+        """Estimate of number of distinct values of keys in the stage, None if unknown"""
+        return (self.stages.get(stage) or {}).get('distinct', {}).get(json.dumps(list(keys)))
+
+    def observe(self, stage, table, keys=None):
+        """Pass the table through, recording statistics of the stage once the table is exhausted"""
+        key = None if keys is None else _key_function(keys)
+        sketch = []
+        sketched = set()
+        rows = 0
+        sampled_bytes = 0
+        for line in table:
+            if key is not None:
+                value = key(line)
+                try:
+                    value = hash((value,))
+                except TypeError:
+                    value = hash(repr(value))
+                value = -(value & 0xFFFFFFFFFFFFFFFF)
+                if value not in sketched:
+                    if len(sketch) < STATISTICS_SKETCH_SIZE:
+                        heapq.heappush(sketch, value)
+                        sketched.add(value)
+                    elif value > sketch[0]:
+                        sketched.remove(heapq.heapreplace(sketch, value))
+                        sketched.add(value)
+            if not rows % STATISTICS_SAMPLE_EVERY:
+                sampled_bytes += len(pickle.dumps(line, protocol=pickle.HIGHEST_PROTOCOL))
+            rows += 1
+            yield line
+
+        samples = -(-rows // STATISTICS_SAMPLE_EVERY)
+        record = {'rows' : rows, 'row_bytes' : sampled_bytes / samples if samples else 0}
+        with self.lock:
+            record['distinct'] = dict((self.stages.get(stage) or {}).get('distinct', {}))
+            if key is not None:
+                if len(sketch) < STATISTICS_SKETCH_SIZE:
+                    estimate = len(sketch)
+                else:
+                    estimate = (STATISTICS_SKETCH_SIZE - 1) * 2 ** 64 / -sketch[0]
+                record['distinct'][json.dumps(list(keys))] = round(estimate)
+            self.stages[stage] = record
+
+    def save(self):
+        """Save statistics to the file, if any"""
+        if not self.filename:
+            return
+        temporary = '{}.{}.tmp'.format(self.filename, threading.get_ident())
+        with self.lock, open(temporary, 'w') as file:
+            json.dump(self.stages, file)
+        os.replace(temporary, self.filename)
+
+
+class Memoizer(object):
+    """
+    Bounded cache of outputs of a deterministic mapper, keyed by values of chosen fields of the input row.
+    The output of the mapper should depend only on the chosen fields and on the declared pass-through fields,
+    that it copies unchanged from the input row: those are taken from the current row on a cache hit, all
+    other values of the cached output are shared between the rows.
+    """
+
+    def __init__(self, fields=None, size=None, policy='lru', filename=None, passthrough=()):
+        """
+        Keyword arguments:
+        fields      -- None to key the cache by whole rows, or a tuple of fields the output depends on
+        passthrough -- fields that the mapper copies from the input row to its output unchanged
+        size        -- the number of inputs to keep outputs for (MEMOIZE_SIZE by default)
+        policy      -- 'lru' to evict the least recently used output, 'lfu' to evict the least frequently used
+        filename    -- None or pickle file to load the cache from before each map and to save it to after it.
+                       The file holds the fingerprint of the mapper, outputs saved for another mapper
+                       (or for a mapper that can not be fingerprinted) are not used
+        """
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown eviction policy for memoize')
+        self.fields = None if fields is None else tuple(fields)
+        self.passthrough = tuple(passthrough)
+        self.size = size or MEMOIZE_SIZE
+        self.policy = policy
+        self.filename = filename
+        self.key = _distinct_key_function(self.fields)
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.counts = {}
+        self.buckets = collections.defaultdict(collections.OrderedDict)
+        self.min_count = 0
+        self.mapper = None
+        self.fingerprint = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock'], state['key']
+        state['mapper'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.key = _distinct_key_function(self.fields)
+
+    def hit_ratio(self):
+        """Share of rows whose output was taken from the cache, None before the first row"""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def _get(self, key):
+        """Cached output for the key or None, counting the use"""
+        outputs = self.entries.get(key)
+        if outputs is None:
+            return None
+        if self.policy == 'lru':
+            self.entries.move_to_end(key)
+        else:
+            count = self.counts[key]
+            del self.buckets[count][key]
+            if not self.buckets[count]:
+                del self.buckets[count]
+                if self.min_count == count:
+                    self.min_count = count + 1
+            self.counts[key] = count + 1
+            self.buckets[count + 1][key] = None
+        return outputs
+
+    def _put(self, key, outputs):
+        """Add an output to the cache, evicting one if the cache is full"""
+        if key in self.entries:
+            return
+        if len(self.entries) >= self.size:
+            if self.policy == 'lru':
+                self.entries.popitem(last=False)
+            else:
+                evicted, _ = self.buckets[self.min_count].popitem(last=False)
+                if not self.buckets[self.min_count]:
+                    del self.buckets[self.min_count]
+                del self.entries[evicted], self.counts[evicted]
+        self.entries[key] = outputs
+        if self.policy == 'lfu':
+            self.counts[key] = 1
+            self.buckets[1][key] = None
+            self.min_count = 1
+
+    def map(self, mapper, line):
+        """Output of the mapper for the line, taken from the cache if possible"""
+        key = self.key(line)
+        with self.lock:
+            outputs = self._get(key)
+            if outputs is not None:
+                self.hits += 1
+        if outputs is not None:
+            return [{**output, **{field : line[field] for field in self.passthrough if field in output}}
+                    for output in outputs]
+        result = list(mapper(line))
+        with self.lock:
+            self.misses += 1
+            self._put(key, [dict(output) for output in result])
+        return result
+
+    def load(self, mapper):
+        """Prepare the cache for the mapper: drop outputs of another mapper, and load the outputs saved
+        for this one from the file, if it was given"""
+        with self.lock:
+            if mapper is self.mapper:
+                return
+            try:
+                fingerprint = _fingerprint(mapper)
+            except _Unfingerprintable:
+                fingerprint = None
+            self.mapper = mapper
+            if fingerprint is not None and fingerprint == self.fingerprint:
+                return
+            self.fingerprint = fingerprint
+            self.entries.clear()
+            self.counts.clear()
+            self.buckets.clear()
+            self.min_count = 0
+            if fingerprint is None or not self.filename or not os.path.exists(self.filename):
+                return
+            with open(self.filename, 'rb') as file:
+                saved = pickle.load(file)
+            if isinstance(saved, tuple) and saved[0] == fingerprint:
+                for key, outputs in saved[1]:
+                    self._put(key, outputs)
+
+    def save(self):
+        """Save the cache together with the fingerprint of its mapper to the file, if it was given"""
+        if not self.filename or self.fingerprint is None:
+            return
+        with self.lock:
+            saved = (self.fingerprint, list(self.entries.items()))
+        temporary = '{}.{}.tmp'.format(self.filename, threading.get_ident())
+        with open(temporary, 'wb') as file:
+            pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.filename)
+
+
+class Tracer(object):
+    """
+    Timeline of evaluations: begin and end of every graph and of every stage (the table after the source and
+    after each operation), events of kept and reused results, memoization, spills and checkpoints, and
+    optionally live memory attributed to operations by sampled tracemalloc snapshots.
+    Stages of a graph run interleaved as generators, so they are recorded as asynchronous spans from the first
+    row requested to the last one. The timeline is saved in Chrome trace event format, which can be opened in
+    chrome://tracing or Perfetto.
+    """
+
+    # Functions whose live allocations (including those of the mappers, reducers etc. they call) are
+    # attributed to an operation, the innermost of them in the traceback wins
+    MEMORY_OWNERS = (
+        ('ExecutionContext', 'iterate', 'kept results'),
+        ('ComputeGraph', '_source_wrapper', 'source'),
+        ('ComputeGraph', '_parse_file', 'source'),
+        ('ComputeGraph', '_parse_files_in_parallel', 'source'),
+        ('ComputeGraph', '_map', 'map'),
+        ('ComputeGraph', '_sort', 'sort'),
+        ('ComputeGraph', '_fold', 'fold'),
+        ('ComputeGraph', '_distinct', 'distinct'),
+        ('ComputeGraph', '_reduce', 'reduce'),
+        ('ComputeGraph', '_join', 'join'),
+    )
+
+    def __init__(self, memory=False, memory_interval=None):
+        """
+        Keyword arguments:
+        memory          -- whether to sample live memory by operations with tracemalloc (slows evaluation down)
+        memory_interval -- minimal number of seconds between memory samples (TRACE_MEMORY_INTERVAL by default)
+        """
+        self.memory = memory
+        self.memory_interval = TRACE_MEMORY_INTERVAL if memory_interval is None else memory_interval
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.span_ids = itertools.count(1)
+        self.next_sample = self.start
+        self.owners = None
+        self.started_tracemalloc = False
+
+    def _add(self, event):
+        event.update(pid=os.getpid(), tid=threading.get_ident(), ts=(time.perf_counter() - self.start) * 1e6)
+        with self.lock:
+            self.events.append(event)
+
+    def instant(self, name, category, **args):
+        """Record an event at the current moment"""
+        self._add({'name' : name, 'cat' : category, 'ph' : 'i', 's' : 't', 'args' : args})
+
+    def span(self, table, name, category, **args):
+        """Pass the table through, recording a span from the first row requested to the exhaustion of the
+        table, with the number of rows and the time spent waiting for them (including preceding stages)"""
+        span_id = next(self.span_ids)
+        table = iter(table)
+        rows = 0
+        busy = 0.0
+        self._add({'name' : name, 'cat' : category, 'ph' : 'b', 'id' : span_id, 'args' : args})
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    line = next(table)
+                except StopIteration:
+                    return
+                finally:
+                    busy += time.perf_counter() - started
+                rows += 1
+                if self.memory and time.perf_counter() >= self.next_sample:
+                    self.sample_memory()
+                yield line
+        finally:
+            self._add({'name' : name, 'cat' : category, 'ph' : 'e', 'id' : span_id,
+                       'args' : {'rows' : rows, 'busy_ms' : busy * 1000}})
+
+    def start_memory(self):
+        """Start tracemalloc if memory is sampled and it is not running yet"""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_MEMORY_FRAMES)
+            self.started_tracemalloc = True
+
+    def stop_memory(self):
+        """Take the last memory sample and stop tracemalloc if it was started by start_memory"""
+        if self.memory and tracemalloc.is_tracing():
+            self.sample_memory()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def _owner(self, traceback):
+        """Operation the allocation with the traceback belongs to, 'other' if none"""
+        for frame in reversed(traceback):
+            for first, last, operation in self.owners.get(frame.filename, ()):
+                if first <= frame.lineno < last:
+                    return operation
+        return 'other'
+
+    def sample_memory(self):
+        """Record a counter event with live bytes by operations"""
+        started = time.perf_counter()
+        self.next_sample = started + self.memory_interval
+        if not tracemalloc.is_tracing():
+            return
+        if self.owners is None:
+            self.owners = collections.defaultdict(list)
+            for class_name, function_name, operation in self.MEMORY_OWNERS:
+                code = getattr(globals()[class_name], function_name).__code__
+                last = max(line for _, line in dis.findlinestarts(code) if line is not None)
+                self.owners[code.co_filename].append((code.co_firstlineno, last + 1, operation))
+        sizes = collections.Counter()
+        owners = {}
+        for trace in tracemalloc.take_snapshot().traces:
+            if trace.traceback not in owners:
+                owners[trace.traceback] = self._owner(trace.traceback)
+            sizes[owners[trace.traceback]] += trace.size
+        self._add({'name' : 'live memory, bytes', 'cat' : 'memory', 'ph' : 'C', 'args' : dict(sizes)})
+        finished = time.perf_counter()
+        self.next_sample = max(self.next_sample, finished + TRACE_MEMORY_OVERHEAD * (finished - started))
+
+    def chrome_trace(self):
+        """The timeline as a dict of Chrome trace event format"""
+        with self.lock:
+            return {'traceEvents' : sorted(self.events, key=operator.itemgetter('ts')), 'displayTimeUnit' : 'ms'}
+
+    def save(self, filename):
+        """Save the timeline to a json file in Chrome trace event format"""
+        with open(filename, 'w') as file:
+            json.dump(self.chrome_trace(), file, default=repr)
+
+
+class _PipeFailure(object):
+    """Exception raised by the producing thread of a _Pipe, passed to the consuming thread"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Pipe(object):
+    """Stage of a pipelined evaluation: a thread iterates over the table of the stage and puts batches of its
+    rows into a bounded queue, the next stage reads them from the queue. The thread blocks while the queue is
+    full, so a stage never runs more than the size of the queue ahead of the next one."""
+
+    _END = object()
+
+    def __init__(self, table, batch_lines, queue_batches, name):
+        self.name = name
+        self.batch_lines = batch_lines
+        self.queue = queue.Queue(queue_batches)
+        self.stopped = threading.Event()
+        self.lines = 0
+        self.batches = 0
+        self.occupancy = 0
+        self.producer_blocked = 0
+        self.consumer_waited = 0
+        self.thread = threading.Thread(target=self._produce, args=(table,), name=name, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        """Put the item into the queue, returns False if the consumer has stopped reading"""
+        if self.queue.full():
+            self.producer_blocked += 1
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, table):
+        try:
+            batch = []
+            for line in table:
+                batch.append(line)
+                if len(batch) >= self.batch_lines:
+                    if not self._put(batch):
+                        return
+                    batch = []
+            if batch and not self._put(batch):
+                return
+            self._put(self._END)
+        except BaseException as error:
+            self._put(_PipeFailure(error))
+
+    def __iter__(self):
+        try:
+            while True:
+                self.occupancy += self.queue.qsize()
+                if self.queue.empty():
+                    self.consumer_waited += 1
+                item = self.queue.get()
+                if item is self._END:
+                    return
+                if isinstance(item, _PipeFailure):
+                    raise item.error
+                self.batches += 1
+                self.lines += len(item)
+                yield from item
+        finally:
+            self.stopped.set()
+
+    def report(self):
+        """Occupancy of the queue: lines and batches passed, average share of the queue filled when a batch was
+        read, and how many times the producer found the queue full and the consumer found it empty"""
+        reads = self.batches + 1
+        return {
+            'stage' : self.name,
+            'lines' : self.lines,
+            'batches' : self.batches,
+            'occupancy' : self.occupancy / reads / self.queue.maxsize,
+            'producer_blocked' : self.producer_blocked,
+            'consumer_waited' : self.consumer_waited,
+        }
+
+
+class Pipeline(object):
+    """
+    Settings of pipelined evaluation and occupancy of its queues. Chosen stages of graphs (the table after the
+    source and after each operation) are produced by separate threads and passed to the next stage through
+    bounded queues of row batches, so that reading and parsing files overlap with the operations.
+    """
+
+    def __init__(self, stages=None, batch_lines=None, queue_batches=None):
+        """
+        Keyword arguments:
+        stages          -- None for all stages, or numbers of stages to produce in separate threads:
+                           0 for the source, i for the i-th operation of each graph
+        batch_lines     -- lines in a batch (PIPELINE_BATCH_LINES by default)
+        queue_batches   -- batches in a queue (PIPELINE_QUEUE_BATCHES by default)
+        """
+        self.stages = None if stages is None else set(stages)
+        self.batch_lines = batch_lines or PIPELINE_BATCH_LINES
+        self.queue_batches = queue_batches or PIPELINE_QUEUE_BATCHES
+        self.pipes = []
+        self.lock = threading.Lock()
+
+    def pipe(self, graph, stage, table):
+        """The table of the stage of the graph, produced by a separate thread if the stage is chosen"""
+        if self.stages is not None and stage not in self.stages:
+            return table
+        operation = graph.operations[stage - 1][0].lstrip('_') if stage else 'source'
+        pipe = _Pipe(table, self.batch_lines, self.queue_batches,
+                     'mrop-{:x}-{}-{}'.format(id(graph), stage, operation))
+        with self.lock:
+            self.pipes.append(pipe)
+        return pipe
+
+    def report(self):
+        """List of queue occupancy reports (see _Pipe.report) of all pipelined stages, in order of their start"""
+        with self.lock:
+            return [pipe.report() for pipe in self.pipes]
+
+
+class ExecutionContext(object):
+    """
+    State of one evaluation of a graph: settings of the run and results of the graphs that are used more than
+    once, kept until their last use. Graphs are not modified while being evaluated, so the same graphs can be
+    evaluated in many contexts at once.
+    """
+
+    def __init__(self, verbose=False, checkpoint_dir=None, statistics=None, pipeline=None, share_prefixes=False,
+                 tracer=None):
+        """
+        Keyword arguments:
+        verbose         -- whether to generate verbose tracking while evaluating
+        checkpoint_dir  -- None or directory for checkpoints (see ComputeGraph.run)
+        statistics      -- None or Statistics to collect and to plan joins with
+        pipeline        -- None or Pipeline to run stages in separate threads with
+        share_prefixes  -- whether to evaluate once the same sources with the same leading operations
+                           of different graphs (see plan). Lists are fingerprinted by contents for that,
+                           which costs a pass over them
+        tracer          -- None or Tracer to record the timeline of the evaluation to
+        """
+        self.verbose = verbose
+        self.checkpoint_dir = checkpoint_dir
+        self.statistics = statistics
+        self.pipeline = pipeline
+        self.share_prefixes = share_prefixes
+        self.tracer = tracer
+        self.prefixes = {}
+        self.uses_left = {}
+        self.results = {}
+        self.evaluations = {}
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+
+    def print(self, *args, **kwargs):
+        """Print if self.verbose is True"""
+        if self.verbose:
+            print(*args, **kwargs)
+
+    def plan(self, graph):
+        """Topological sort. The idea is first to traverse the composition of graphs in the same order
+        that it will be traversed in the computation (when entering a graph that was already passed, further
+        dependencies are not added to the sequence).
+        Then those graphs that are computed more then once are told that they should save the result and delete
+        it in the last call (to free the memory).
+        Before that, stages of different graphs with the same fingerprints are found, and each graph is made
+        to start from a graph of its longest shared prefix (see _plan_prefixes), so that the prefix is
+        computed once and its result is kept the same way.
+        """
+        self.print('plan entered')
+
+        def traverse(graph, links):
+            sequence.append(graph)
+            if graph not in visited:
+                visited.add(graph)
+                for link in links(graph):
+                    traverse(link, links)
+
+        if self.share_prefixes:
+            sequence = []
+            visited = set()
+            traverse(graph, ComputeGraph._dependencies)
+            self._plan_prefixes(visited)
+        sequence = []
+        visited = set()
+        traverse(graph, self.links)
+        self.print('plan got sequence', sequence)
+        for i, graph in enumerate(sequence[:-1]):
+            if graph not in self.uses_left:
+                self.uses_left[graph] = sequence[i + 1:].count(graph)
+
+    def event(self, name, category, **args):
+        """Record an event in the timeline, if it is traced"""
+        if self.tracer is not None:
+            self.tracer.instant(name, category, **args)
+
+    def traced(self, table, name, category, **args):
+        """Pass the table through a span of the timeline, if it is traced"""
+        if self.tracer is None:
+            return table
+        return self.tracer.span(table, name, category, **args)
+
+    def links(self, graph):
+        """Graphs whose results are used by the graph in this context, in the order they are used"""
+        if graph not in self.prefixes:
+            return graph._dependencies()
+        prefix, stage = self.prefixes[graph]
+        return [prefix] + [operation[1] for operation in graph.operations[stage:]
+                           if operation[0] == '_join' and isinstance(operation[1], ComputeGraph)]
+
+    def _plan_prefixes(self, graphs):
+        """Find stages (after at least one operation) that have the same fingerprint in several graphs.
+        Each graph gets the longest of its shared stages: a graph of the operations up to that stage, which
+        is evaluated instead of them. Graphs of prefixes get a shorter prefix in turn, if it is shared by
+        more graphs."""
+        graphs = [graph for graph in graphs
+                  if graph.operations and graph.finalized and graph.source and not graph.result]
+        if len(graphs) < 2:
+            return
+        owners = collections.defaultdict(set)
+        stages = {}
+        for graph in graphs:
+            fingerprints = self.stage_fingerprints(graph)
+            if fingerprints:
+                stages[graph] = fingerprints
+                for fingerprint in fingerprints[1:]:
+                    owners[fingerprint].add(graph)
+        prefixes = {}
+
+        def shared(fingerprints, last, consumers):
+            return next((stage for stage in range(last, 0, -1) if len(owners[fingerprints[stage]]) > consumers),
+                        None)
+
+        def prefix(graph, fingerprints, stage):
+            if fingerprints[stage] not in prefixes:
+                prefix_graph = prefixes[fingerprints[stage]] = graph._prefix(stage)
+                self.fingerprints[prefix_graph] = fingerprints[:stage + 1]
+                shorter = shared(fingerprints, stage - 1, len(owners[fingerprints[stage]]))
+                if shorter is not None:
+                    self.prefixes[prefix_graph] = (prefix(graph, fingerprints, shorter), shorter)
+            return prefixes[fingerprints[stage]]
+
+        for graph, fingerprints in stages.items():
+            stage = shared(fingerprints, len(fingerprints) - 1, 1)
+            if stage is not None:
+                self.print('plan shares {} operations of graph {}'.format(stage, graph))
+                self.prefixes[graph] = (prefix(graph, fingerprints, stage), stage)
+
+    def stage_fingerprints(self, graph):
+        """Fingerprints of the stages of the graph, computed once per context. None if there are none"""
+        with self.lock:
+            if graph in self.fingerprints:
+                return self.fingerprints[graph]
+        try:
+            fingerprints = graph._stage_fingerprints(self.stage_fingerprints)
+        except _Unfingerprintable as error:
+            self.print('stage_fingerprints: source or operations can not be fingerprinted, class = ', graph)
+            if self.checkpoint_dir:
+                warnings.warn('Stages of {} are not checkpointed, since {!r} used by it can not be '
+                              'fingerprinted'.format(_graph_name(graph), error.args[0]), stacklevel=2)
+            fingerprints = None
+        with self.lock:
+            return self.fingerprints.setdefault(graph, fingerprints)
+
+    def rows(self, table):
+        """Rows of a table, that is either a graph or an iterable"""
+        if isinstance(table, ComputeGraph):
+            return self.iterate(table)
+        return table
+
+    def iterate(self, graph):
+        """Iterate over result of the graph, evaluating it in this context. A graph used several times is
+        evaluated once, its result is kept until the last use."""
+        if graph.result:
+            self.print("\tresult of run() already here, class = ", graph)
+            yield from graph.result
+            return
+        with self.lock:
+            evaluation = self.evaluations.setdefault(graph, threading.Lock())
+        # Pipelined stages may ask for a graph used several times from different threads at once,
+        # it is evaluated by the first of them while the others wait
+        with evaluation:
+            with self.lock:
+                result = self.results.get(graph)
+                if result is not None:
+                    self.uses_left[graph] -= 1
+                    if not self.uses_left[graph]:
+                        del self.results[graph]
+                    self.event('result reused', 'cache', graph=_graph_name(graph), uses_left=self.uses_left[graph])
+            if result is None and graph.finalized and graph.source and self.uses_left.get(graph):
+                self.print("\twill evaluate and keep result, class = ", graph)
+                result = list(self.traced(graph._result_generator(self), _graph_name(graph), 'graph'))
+                with self.lock:
+                    self.results[graph] = result
+                self.event('result kept', 'cache', graph=_graph_name(graph), rows=len(result))
+        if result is not None:
+            self.print("\tresult already here, class = ", graph)
+            yield from result
+        elif not graph.finalized:
+            raise ComputeGraphError('Run of a nonfinalized graph')
+        elif not graph.source:
+            raise ComputeGraphError('Source not specified')
+        else:
+            self.print("\twill evaluate result, class = ", graph)
+            yield from self.traced(graph._result_generator(self), _graph_name(graph), 'graph')
+
+
+def _graph_name(graph):
+    """Name of the graph in traces"""
+    return 'graph {:x}'.format(id(graph))
+
+
+def _evaluate(graph, source=None, **kwargs):
+    """ComputeGraph.evaluate as a function, to be sent to worker processes"""
+    return graph.evaluate(source=source, **kwargs)
+
+
 class ComputeGraph(object):
     """
     Each graph is defined as sequence of elementary operation (map, sort, fold, reduce, join). 
@@ -19,6 +1432,10 @@ class ComputeGraph(object):
     After being defined, graph should be finalized and then it can be evaluated on an arbitrary input, or used
     as a dependence for another graph.
 
+    The state of an evaluation is kept in an ExecutionContext, not in the graphs, so a finalized graph can be
+    evaluated for different sources in several threads or processes at once (see evaluate and evaluate_many).
+    Only run() stores the result in the graph.
+
     Example of usage:
 
         word_count = mrop.ComputeGraph()
@@ -30,77 +1447,102 @@ class ComputeGraph(object):
         word_count.save_to_file('word_count.txt')
     """
 
-    def __init__(self, source=None, verbose=False):
+    def __init__(self, source=None, verbose=False, read_workers=1):
         """
         Keyword arguments:
         source: string or ComputeGraph obj, optional -- specify source for the graph, 
                                                         either string with a filename or another graph
+                                                        (see change_source for all kinds of sources)
         verbose: boolean, optional                   -- whether to generate verbose tracking while evaluating,
                                                         spreads to the dependent graphs
+        read_workers: int, optional                  -- number of processes reading a file source
         """
         self.finalized = False
         self.dependences = []
         self.operations = []
-        self.visited_by_sort = False
-        self.n_to_be_used_again = 0
-        self.save_intermediate = None
         self.verbose = verbose
         self.result = None
 
         self.source_data = None
-        self.source_filename = None
+        self.source_filenames = None
+        self.read_workers = 1
 
-        if source:
-            self.change_source(source)
+        if source is not None:
+            self.change_source(source, read_workers)
         else:
             self.source = None
 
-    def _print(self, *args, **kwargs):
-        """Print if self.verbose is True"""
-        if self.verbose:
-            print(*args, **kwargs)
+    def _parse_file(self, context, filename=None):
+        """Make a generator from a json file, possibly gzip, bz2 or xz compressed.
+        Without filename all files of the source are parsed one after another."""
+        if filename is None:
+            for filename in self.source_filenames:
+                yield from self._parse_file(context, filename)
+            return
+        context.print('_parse_file entered, filename =', filename)
+        compressed = detect_compression(filename) is not None
+        with open_file(filename) as file:
+            yield from _parse_lines(_background_lines(file) if compressed else file)
 
-    def _parse_file(self):
-        """Make a generator from a json file"""
-        self._print('_parse_file entered')
-        with open(self.source_filename) as file:
-            for line in file:
-                yield json.loads(line)
+    def _parse_files_in_parallel(self, context, mappers, fold=None):
+        """Parse files of the source in self.read_workers processes, applying mappers to each file there.
+        Files are yielded in the order of the source, at most 2 * read_workers of them are kept in flight.
+        If fold (folder, initial) is given, the folded state of each file is yielded instead of its rows."""
+        context.print('_parse_files_in_parallel entered, mappers =', mappers)
+        with concurrent.futures.ProcessPoolExecutor(self.read_workers) as executor:
+            pending = collections.deque()
+            for filename in self.source_filenames:
+                pending.append(executor.submit(_read_partition, filename, mappers, fold))
+                if len(pending) >= 2 * self.read_workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
 
-    def _source_wrapper(self):
+    def _source_wrapper(self, context):
         """wrapper for source not from file"""
-        self._print('_source_wrapper entered, class=', self)
-        yield from iter(self.source_data)
+        context.print('_source_wrapper entered, class=', self)
+        yield from iter(context.rows(self.source_data))
 
-    def map(self, mapper):
+    def map(self, mapper, memoize=None):
         """
         Add map operation to the graph. Map applies mapper to each row of the table, and gather all yielded 
         rows to the result table. 
 
         Keyword arguments:
 
-        mapper -- a mapper function (returning iterable) to be applied to each row of the table.
-                  Takes a row of the table (a dict) and after processing yields row or rows.
-                  Should return iterable
+        mapper  -- a mapper function (returning iterable) to be applied to each row of the table.
+                   Takes a row of the table (a dict) and after processing yields row or rows.
+                   Should return iterable
+        memoize -- None, True, a tuple of fields or a Memoizer. If not None, outputs of the deterministic
+                   mapper are cached by values of the fields (by whole rows for True), see Memoizer
         """
         if self.finalized:
             raise ComputeGraphError('Adding operations to finalized graph')
-        self.operations.append(('_map', mapper))
+        if memoize is None:
+            self.operations.append(('_map', mapper))
+            return self
+        if memoize is True:
+            memoize = Memoizer()
+        elif not isinstance(memoize, Memoizer):
+            memoize = Memoizer(memoize)
+        self.operations.append(('_map', mapper, memoize))
         return self
 
-    def sort(self, keys):
+    def sort(self, keys, n_workers=1):
         """
         Add sort operation to the graph. Sort sorts table using keys as keys for sort.
         
         Keyword arguments:
-        keys    --      a tuple of keys, defining the order to sort the table with
+        keys        --  a tuple of keys, defining the order to sort the table with
+        n_workers   --  number of processes to sort with. Tables of at least PARALLEL_SORT_MIN_LINES lines
+                        are split into chunks sorted by the processes and merged back
         """
         if self.finalized:
             raise ComputeGraphError('Adding operations to finalized graph')
-        self.operations.append(('_sort', keys))
+        self.operations.append(('_sort', keys, n_workers))
         return self
 
-    def fold(self, folder, initial=None):
+    def fold(self, folder, initial=None, merge=None, n_workers=1):
         """
         Add fold operation to the graph. Fold applies folder consequently to all rows from the table,
         second argument of folder being transfered to the next application of folder.
@@ -113,12 +1555,40 @@ class ComputeGraph(object):
                     Applying folder to the last row from the table gives the final result of fold
         initial --  dict to be passed to the second argument of folder when calling it the first time,
                     passing the first row of the table as the first argument to folder
+        merge   --  None or an associative function of two states, returning the state of folding both
+                    parts of the table one after another. If given, parts of the table are folded
+                    independently, each starting from initial, and their states are merged pairwise:
+                    files of a partitioned source in its reader processes (when the fold follows
+                    only maps), chunks of the table in n_workers processes otherwise.
+                    folder and merge should be picklable then
+        n_workers --  number of processes to fold chunks of the table with, if merge is given
         """
         if self.finalized:
             raise ComputeGraphError('Adding operations to finalized graph')
-        self.operations.append(('_fold', folder, initial))
+        if merge is None:
+            self.operations.append(('_fold', folder, initial))
+        else:
+            self.operations.append(('_fold', folder, initial, merge, n_workers))
         return self      
 
+    def distinct(self, keys=None, keep='first', memory_rows=None):
+        """
+        Add distinct operation to the graph. Distinct leaves one row for each value of keys, without sorting
+        the table. Rows are kept in the order of the table while the set of seen keys fits in memory.
+
+        Keyword arguments:
+        keys        --  keys to compare rows with, whole rows are compared if not given
+        keep        --  'first' or 'last': which row to leave of the rows with the same keys
+        memory_rows --  the number of keys to keep in memory (DISTINCT_MEMORY_ROWS by default), the rest of
+                        the table is deduplicated through files on disk
+        """
+        if self.finalized:
+            raise ComputeGraphError('Adding operations to finalized graph')
+        if keep not in ('first', 'last'):
+            raise ValueError('Unknown row to keep for distinct')
+        self.operations.append(('_distinct', keys, keep, memory_rows))
+        return self
+
     def reduce(self, reducer, keys):
         """
         Add reduce operation to the graph. The graph shouls be sorted with respect to keys.
@@ -136,7 +1606,7 @@ class ComputeGraph(object):
         self.operations.append(('_reduce', reducer, keys))
         return self
 
-    def join(self, on, keys, strategy='inner'):
+    def join(self, on, keys, strategy='inner', algorithm='auto', bloom=False):
         """
         Add join operation to the graph. Join performs SQL join table with another table, passed to argument 'on'.
 
@@ -144,10 +1614,31 @@ class ComputeGraph(object):
         on                                                --  the table to join the current table to
         keys                                              --  keys for join
         strategy ('inner', 'left', 'right' or 'outer')    --  strategy of SQL join
+        algorithm ('auto', 'broadcast', 'hash', 'sort',   --  'broadcast' loads 'on' into memory and streams the
+                   'grace' or 'index')                        table through it, 'hash' does the same with the side
+                                                              that was smaller in previous runs (see Statistics),
+                                                              'sort' sorts and groups both sides,
+                                                              'grace' partitions both sides to disk and joins them
+                                                              bucket by bucket with bounded memory, 'index' reads
+                                                              only matching lines of the file indexed by keys
+                                                              (see JsonLinesIndex), 'on' being the index or a graph
+                                                              without operations reading the file.
+                                                              'auto' uses an index if 'on' is one, or if it has been
+                                                              built for the file and the table is small; otherwise
+                                                              chooses the algorithm and the side to build by cost
+                                                              if statistics of previous runs are known for both
+                                                              sides; otherwise broadcasts whichever side is known
+                                                              or measured to have at most BROADCAST_JOIN_ROWS rows,
+                                                              sorts if both sides fit in JOIN_MEMORY_ROWS and uses
+                                                              'grace' otherwise
+        bloom                                             --  for 'inner' and 'right' joins: read 'on' first and
+                                                              drop lines of the table whose keys are not in a Bloom
+                                                              filter built over keys of 'on'. The filter is applied
+                                                              below the sorts that directly precede the join
         """
         if self.finalized:
             raise ComputeGraphError('Adding operations to finalized graph')
-        self.operations.append(('_join', on, keys, strategy))
+        self.operations.append(('_join', on, keys, strategy, algorithm, bloom))
         if isinstance(on, ComputeGraph):
             self.dependences.append(on)
         return self
@@ -160,13 +1651,30 @@ class ComputeGraph(object):
             self.finalized=True
         return self
 
-    def change_source(self, source):
+    def change_source(self, source, read_workers=1):
         """Change source for the graph
 
         source (iterable object or string with filename)    -- new source for the graph.
+                                                               Files compressed with gzip, bz2 or xz are
+                                                               decompressed on the fly.
+                                                               A directory, a glob pattern or a list of
+                                                               filenames make a partitioned source, each
+                                                               file being a partition.
+                                                               A directory with a table saved by
+                                                               save_columnar is read as ColumnarTable
+        read_workers (int)                                  -- number of processes to read the files of the
+                                                               source with. Leading map operations of the
+                                                               graph are applied in those processes, so
+                                                               their mappers should be picklable
         """
-        if isinstance(source, str):
-            self.source_filename = source
+        if isinstance(source, str) and is_columnar(source):
+            source = ColumnarTable(source)
+        filenames = expand_source_files(source)
+        if filenames is not None:
+            if not filenames:
+                raise ComputeGraphError('No files found for source {}'.format(source))
+            self.source_filenames = filenames
+            self.read_workers = read_workers
             self.source = self._parse_file
         else:
             if not hasattr(source, '__iter__'):
@@ -177,140 +1685,421 @@ class ComputeGraph(object):
         return self
 
 
-    def run(self, save_intermediate=None, source=None, verbose=False):
+    def run(self, save_intermediate=None, source=None, verbose=False, executor=None, checkpoint_dir=None,
+            statistics=None, pipeline=None, trace=None, share_prefixes=False):
         """
-        Run the calculation, defined by the graph (should be finalized)
+        Run the calculation, defined by the graph (should be finalized), and keep the result in the graph
 
         Keyword arguments:
         save_intermediate -- None, True or list of dependent graphs (default=None)
-                             Keep the result of the evaluation in the memory (in each graph)
+                             Kept for compatibility, results of dependent graphs are kept while they are needed
         source            -- generator or str with filename (default=None)
                              If not None change the source for the graph
         verbose           -- True/False (default=None)
                              Whether to trace evaluation
+        executor          -- None or mrop_distributed.DistributedExecutor (default=None)
+                             If not None evaluate the graph on the workers of the executor
+        checkpoint_dir    -- None or str with a directory name (default=None)
+                             If not None save checkpoints after each sort and join and after each graph
+                             to the directory. Evaluation resumes from the latest valid checkpoint,
+                             written by a previous run with the same sources and operations
+        statistics        -- None, Statistics or str with a filename (default=None)
+                             If not None collect statistics of all stages, use statistics of previous runs
+                             to choose join algorithms, and save them to the file
+        pipeline          -- None, True or Pipeline (default=None)
+                             If not None run stages of the graphs in separate threads connected by bounded
+                             queues, queue occupancy is reported by Pipeline.report
+        trace             -- None, Tracer or str with a filename (default=None)
+                             If not None record the timeline of the evaluation to the Tracer, or to a new
+                             one saved to the file in Chrome trace event format
+        share_prefixes    -- True/False (default=False)
+                             Whether to evaluate once the same sources with the same leading operations
+                             of the graphs this graph depends on
         """
         if self.result:
             return self.result
         else:
-            self.save_intermediate = save_intermediate
-            self.verbose = verbose
-            if source:
+            if source is not None:
                 self.change_source(source)
-            self.result = list(self.__iter__())
+            if executor is not None:
+                self.result = executor.run(self)
+            else:
+                self.result = self.evaluate(verbose=verbose, checkpoint_dir=checkpoint_dir, statistics=statistics,
+                                            pipeline=pipeline, trace=trace, share_prefixes=share_prefixes)
             return self.result
 
+    def evaluate(self, source=None, verbose=False, checkpoint_dir=None, statistics=None, pipeline=None,
+                 trace=None, share_prefixes=False):
+        """
+        Evaluate the graph and return the result as a list, without changing the graph.
+        Can be called for the same graph from many threads at once.
+
+        Keyword arguments:
+        source            -- None or any source accepted by change_source (default=None)
+                             If not None evaluate the graph for this source instead of its own
+        verbose           -- True/False (default=False)
+                             Whether to trace evaluation
+        checkpoint_dir    -- None or str with a directory name (default=None), see run
+        statistics        -- None, Statistics or str with a filename (default=None), see run
+        pipeline          -- None, True or Pipeline (default=None), see run
+        trace             -- None, Tracer or str with a filename (default=None), see run
+        share_prefixes    -- True/False (default=False), see run
+        """
+        graph = self
+        if source is not None:
+            graph = copy.copy(self)
+            graph.result = None
+            graph.change_source(source, self.read_workers)
+        if isinstance(statistics, str):
+            statistics = Statistics(statistics)
+        if pipeline is True:
+            pipeline = Pipeline()
+        tracer = Tracer() if isinstance(trace, str) else trace
+        context = ExecutionContext(verbose or self.verbose, checkpoint_dir, statistics, pipeline, share_prefixes,
+                                   tracer)
+        if tracer is not None:
+            tracer.start_memory()
+        try:
+            result = list(graph._evaluate(context))
+        finally:
+            if tracer is not None:
+                tracer.stop_memory()
+        if isinstance(trace, str):
+            tracer.save(trace)
+        if pipeline is not None:
+            for report in pipeline.report():
+                context.print('pipeline stage', report)
+        if statistics is not None:
+            statistics.save()
+        return result
+
+    def evaluate_many(self, sources, n_workers=None, processes=False, **kwargs):
+        """
+        Evaluate the graph for each of the sources concurrently, return the list of results in the same order.
+
+        Keyword arguments:
+        sources     -- list of sources accepted by change_source
+        n_workers   -- number of threads or processes (default: chosen by concurrent.futures)
+        processes   -- whether to use processes instead of threads. The graph is pickled then,
+                       so its functions should be importable by the processes
+        kwargs      -- passed to evaluate
+        """
+        if processes:
+            pool = concurrent.futures.ProcessPoolExecutor(n_workers)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(n_workers)
+        with pool:
+            return list(pool.map(functools.partial(_evaluate, self, **kwargs), sources))
+
     def __iter__(self):
-        """Iterate over result. Triggers graph evaluation."""
+        """Iterate over result. Triggers graph evaluation, unless the graph has been run."""
         if self.result:
-            self._print("\tresult already here, class = ", self)
             yield from self.result
-            self.n_to_be_used_again -= 1
-            if not self.n_to_be_used_again:
-                self.delete_result()
-        elif not self.finalized:
-            raise ComputeGraphError('Run of a nonfinalized graph')
-        elif not self.source:
-            raise ComputeGraphError('Source not specified')
         else:
-            self._print("\twill evaluate result, class = ", self)
-            if not self.n_to_be_used_again:
-                yield from self._plan_and_run()
-            else:
-                self.result = list(self._plan_and_run())
-                yield from self.result
+            yield from self._evaluate(ExecutionContext(self.verbose))
 
     def delete_result(self):
         """Delete result to free the memory"""
         self.result = None
 
-    def _plan_and_run(self):
-        """First triggers topological sort, then --- computation"""
-        if not self.visited_by_sort:
-            self._topological_sort()
+    def _evaluate(self, context):
+        """First plans the evaluation in the context, then --- computation"""
+        context.plan(self)
+        yield from context.iterate(self)
 
-        # sys.exit()
-        self.visited_by_sort = False
-        yield from self._result_generator()
+    def _prefix(self, stage):
+        """Finalized graph with the same source and the operations of this graph up to the stage"""
+        prefix = copy.copy(self)
+        prefix.result = None
+        prefix.finalized = True
+        prefix.operations = self.operations[:stage]
+        prefix.dependences = [operation[1] for operation in prefix.operations
+                              if operation[0] == '_join' and isinstance(operation[1], ComputeGraph)]
+        prefix.source = prefix._parse_file if self.source == self._parse_file else prefix._source_wrapper
+        return prefix
 
+    def _dependencies(self):
+        """Graphs whose results are used by this graph, in the order they are used"""
+        if isinstance(self.source_data, ComputeGraph) and self.source == self._source_wrapper:
+            return [self.source_data] + self.dependences
+        return self.dependences
 
-    def _topological_sort(self):
-        """Topological sort. The idea is first to traverse the composition of graphs in the same order
-        that it will be traversed in the computation (when entering a graph that was already passed, further
-        dependencies are not added to the sequence).
-        Then those graphs that are computed more then once are told that they should save the result and delete
-        it in the last call (to free the memory).
-        """
-        self._print('_topological_sort entered')
-        # self._print('_topological_sort entered, self={}, dependences='.format(self), self.dependences)
-        sequence = []
-        sequence = self._traverse(sequence)
-        self._print('_topological_sort got sequence', sequence)
+    def _source_fingerprint(self, graph_fingerprints=None):
+        """Fingerprint of the source: names, sizes and modification times for files, contents for lists"""
+        if self.source == self._parse_file:
+            files = []
+            for filename in self.source_filenames:
+                stat = os.stat(filename)
+                files.append((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns))
+            return _fingerprint(files)
+        if isinstance(self.source_data, (ComputeGraph, ColumnarTable, list, tuple)):
+            return _fingerprint(self.source_data, graph_fingerprints)
+        raise _Unfingerprintable(self.source_data)
 
-        for i, graph in enumerate(sequence[:-1]):
-            if not graph.n_to_be_used_again:
-                graph.n_to_be_used_again = sequence[i + 1:].count(graph)
+    def _stage_fingerprints(self, graph_fingerprints=None):
+        """Fingerprints of the table after the source and after each operation. Fingerprints of the graphs
+        used by the operations are taken from graph_fingerprints if given (see _fingerprint)"""
+        fingerprints = [self._source_fingerprint(graph_fingerprints)]
+        for operation in self.operations:
+            fingerprints.append(_fingerprint((fingerprints[-1], operation), graph_fingerprints))
+        return fingerprints
 
-    def _traverse(self, sequence):
-        """Traverse the composition of graphs in the same order as further during the computation
-        """
-        # print('_traverse entered, sequence = ', sequence)
-        if self.source == self._source_wrapper and isinstance(self.source_data, ComputeGraph):
-            self.dependences.insert(0, self.source_data)
-        # print('_traverse entered, self = {}, dependences={}'.format(self, self.dependences))
+    def _checkpoint_stages(self, context):
+        """Map from index of operation to the checkpoint filename of the table after it, for the stages
+        that are checkpointed: sorts, joins and the whole graph. Empty if checkpoints are off or impossible."""
+        if not context.checkpoint_dir or not self.operations:
+            return {}
+        fingerprints = context.stage_fingerprints(self)
+        if fingerprints is None:
+            return {}
+        stages = {}
+        for i, operation in enumerate(self.operations):
+            if operation[0] in CHECKPOINT_OPERATIONS or i == len(self.operations) - 1:
+                stages[i + 1] = os.path.join(context.checkpoint_dir, fingerprints[i + 1] + '.checkpoint')
+        return stages
 
-        sequence.append(self)
-        if not self.visited_by_sort:
-            self.visited_by_sort = True
-            for link in self.dependences:
-                sequence = link._traverse(sequence)
-        return sequence
+    def _checkpointed(self, context, table, filename):
+        """Pass the table through, writing it to the checkpoint. The checkpoint becomes valid once
+        the table is exhausted."""
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        temporary = '{}.{}.tmp'.format(filename, threading.get_ident())
+        try:
+            with gzip.open(temporary, 'wb', compresslevel=1) as file:
+                while True:
+                    batch = list(itertools.islice(table, CHECKPOINT_BATCH_LINES))
+                    if not batch:
+                        break
+                    pickle.dump(batch, file, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield from batch
+            os.replace(temporary, filename)
+            context.print('_checkpointed saved', filename)
+            context.event('checkpoint saved', 'checkpoint', filename=filename)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
 
-    def _result_generator(self):
+    def _result_generator(self, context):
         """Internal function that iterates over operations in the graph and triggers evaluation of dependent graphs"""
-        self._print('_result_generator entered, self = ', self)
-        table = self.source()
-        if isinstance(self.source_data, ComputeGraph):
-            self.source_data.verbose = self.verbose
-        # print('table', list(table))
-        # self._print('source', self.source)
-        # self._print('source (->list)', list(self.source()))
-        for operation in self.operations:
-            table = getattr(self, operation[0])(table, *operation[1:])
-            # print('table', list(table))
-            # self._print('table', table)
+        context.print('_result_generator entered, self = ', self)
+        operations = self.operations
+        checkpoints = self._checkpoint_stages(context)
+        first = max((i for i, filename in checkpoints.items() if os.path.exists(filename)), default=0)
+        prefix, shared = context.prefixes.get(self, (None, 0))
+        if shared > first:
+            context.print('_result_generator starts from a shared prefix of {} operations'.format(shared))
+            context.event('shared prefix', 'cache', graph=_graph_name(self), prefix=_graph_name(prefix),
+                          operations=shared)
+            first = shared
+            table = context.iterate(prefix)
+        elif first:
+            context.print('_result_generator resumes from', checkpoints[first])
+            context.event('checkpoint resumed', 'checkpoint', graph=_graph_name(self), filename=checkpoints[first])
+            table = _read_checkpoint(checkpoints[first])
+        elif self.source == self._parse_file and self.read_workers > 1:
+            while first < len(operations) and operations[first][0] == '_map' and len(operations[first]) == 2:
+                first += 1
+            mappers = [operation[1] for operation in operations[:first]]
+            if first < len(operations) and operations[first][0] == '_fold' and len(operations[first]) > 3:
+                _, folder, initial, merge, _ = operations[first]
+                states = self._parse_files_in_parallel(context, mappers, (folder, initial))
+                table = iter([_tree_merge(states, merge, initial)])
+                first += 1
+            else:
+                table = self._parse_files_in_parallel(context, mappers)
+            if first in checkpoints:
+                table = self._checkpointed(context, table, checkpoints[first])
+        else:
+            table = self.source(context)
+        filters, semi_joins = self._semi_joins(context, first)
+        filtered = {i for position, index in zip(filters, semi_joins) for i in range(position + 1, index + 1)}
+        table = self._observed(context, table, first)
+        table = self._traced(context, table, first)
+        table = self._piped(context, table, first)
+        for i, operation in enumerate(operations[first:], first + 1):
+            if i - 1 in filters:
+                table = filters[i - 1].filter(table)
+            if operation[0] == '_join':
+                on = semi_joins.get(i - 1, operation[1])
+                fields = operation[6] if len(operation) > 6 else None
+                table = self._join(context, table, on, *operation[2:5], stage=i - 1, fields=fields)
+                if i - 1 in semi_joins:
+                    table = semi_joins[i - 1].fill(table)
+            else:
+                table = getattr(self, operation[0])(context, table, *operation[1:])
+            if i not in filtered:
+                table = self._observed(context, table, i)
+                if i in checkpoints:
+                    table = self._checkpointed(context, table, checkpoints[i])
+            table = self._traced(context, table, i)
+            table = self._piped(context, table, i)
         return table
 
-    def _map(self, table, mapper):
+    def _traced(self, context, table, stage):
+        """The table after the stage, passed through a span of the timeline if the context is traced"""
+        operation = self.operations[stage - 1][0].lstrip('_') if stage else 'source'
+        return context.traced(table, '{} {}'.format(operation, stage), 'operation', graph=_graph_name(self))
+
+    def _piped(self, context, table, stage):
+        """The table after the stage, produced by a separate thread if the context runs the stage pipelined"""
+        if context.pipeline is None:
+            return table
+        return context.pipeline.pipe(self, stage, table)
+
+    def _semi_joins(self, context, first):
+        """Semi-joins of the joins with bloom=True after the stage 'first'. Returns two dicts with the same
+        order: semi-joins by the index of the operation their filter is applied before (the first of the sorts
+        directly preceding the join, or the join itself), and by the index of their join. Stages between them
+        hold filtered tables, which are neither checkpointed nor observed. Index joins are left as they are,
+        since they do not read 'on' as a whole, and so are joins whose 'on' is known from statistics to be
+        larger than the table, since the filter would hold more keys than there are lines to drop."""
+        filters = {}
+        semi_joins = {}
+        for index, operation in enumerate(self.operations):
+            if (operation[0] != '_join' or index < first or not operation[5]
+                    or operation[3] not in ('inner', 'right')
+                    or operation[4] == 'index' or isinstance(operation[1], JsonLinesIndex)):
+                continue
+            position = index
+            while position > first and self.operations[position - 1][0] == '_sort':
+                position -= 1
+            table_statistics, on_statistics = self._join_statistics(context, position, operation[1])
+            if table_statistics and on_statistics and on_statistics['rows'] > table_statistics['rows']:
+                context.print('_semi_joins skips the Bloom filter of the join {}, its side on is larger'.format(index))
+                continue
+            semi_joins[index] = filters[position] = _SemiJoin(context, operation[1], operation[2])
+        return filters, semi_joins
+
+    def _observed(self, context, table, stage):
+        """Pass the table after the stage through the statistics of the context, if they are collected"""
+        fingerprints = context.statistics is not None and context.stage_fingerprints(self)
+        if not fingerprints:
+            return table
+        following = self.operations[stage] if stage < len(self.operations) else None
+        keys = None
+        if following is not None and following[0] in ('_sort', '_distinct'):
+            keys = following[1]
+        elif following is not None and following[0] in ('_reduce', '_join'):
+            keys = following[2]
+        return context.statistics.observe(fingerprints[stage], table, keys)
+
+    def _map(self, context, table, mapper, memoizer=None):
         """Implementation of map operation"""
-        self._print("_map with {}".format(mapper))
+        context.print("_map with {}".format(mapper))
         # print('table', list(table))
+        if memoizer is None:
+            for line in table:
+                yield from mapper(line)
+            return
+        memoizer.load(mapper)
         for line in table:
-            yield from mapper(line)
+            yield from memoizer.map(mapper, line)
+        context.print("_map with {}: {} hits, {} misses".format(mapper, memoizer.hits, memoizer.misses))
+        context.event('memoize', 'cache', mapper=getattr(mapper, '__qualname__', repr(mapper)),
+                      hits=memoizer.hits, misses=memoizer.misses)
+        memoizer.save()
 
     def _getitems(self, line, keys):
         """Given tuple of keys evaluate values from line"""
         # print('_getitems, line={}, keys={}'.format(line, keys))
         return tuple(line[k] for k in keys)
 
-    def _sort(self, table, keys):
+    def _sort(self, context, table, keys, n_workers=1):
         """Implementation of sort operation"""
-        self._print("_sort using keys={}".format(keys))
-        yield from iter(sorted(table, key=lambda line: self._getitems(line, keys)))
+        context.print("_sort using keys={}".format(keys))
+        table = list(table)
+        if n_workers <= 1 or len(table) < PARALLEL_SORT_MIN_LINES:
+            table.sort(key=_key_function(keys))
+            yield from table
+            return
 
-    def _fold(self, table, folder, initial):
+        n_chunks = n_workers * PARALLEL_SORT_CHUNKS_PER_WORKER
+        size = -(-len(table) // n_chunks)
+        context.print("_sort splits {} lines to {} chunks for {} processes".format(len(table), n_chunks, n_workers))
+        key = _key_function(keys)
+        values = [key(line) for line in table]
+        starts = range(0, len(table), size)
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            runs = list(executor.map(_sort_chunk, (values[i:i + size] for i in starts), starts))
+        for i in heapq.merge(*runs, key=values.__getitem__):
+            yield table[i]
+
+    def _fold(self, context, table, folder, initial, merge=None, n_workers=1):
         """Implementation of fold operation"""
-        self._print("_fold with folder {} and initial {}".format(folder, initial))
-        for line in table:
-            initial = folder(line, initial)
-        yield initial
+        context.print("_fold with folder {} and initial {}".format(folder, initial))
+        if merge is None or n_workers <= 1:
+            for line in table:
+                initial = folder(line, initial)
+            yield initial
+            return
+
+        context.print("_fold folds chunks of {} lines in {} processes".format(PARALLEL_FOLD_CHUNK_LINES, n_workers))
+        table = iter(table)
+        states = []
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            pending = collections.deque()
+            for chunk in iter(lambda: list(itertools.islice(table, PARALLEL_FOLD_CHUNK_LINES)), []):
+                pending.append(executor.submit(_fold_chunk, chunk, folder, initial))
+                if len(pending) >= 2 * n_workers:
+                    states.append(pending.popleft().result())
+            states.extend(future.result() for future in pending)
+        yield _tree_merge(states, merge, initial)
+
+    def _merge_folds(self, context, table, merge, initial):
+        """Merge the table of partial states of a fold, used by DistributedExecutor"""
+        yield _tree_merge(table, merge, initial)
+
+    def _distinct(self, context, table, keys, keep='first', memory_rows=None, depth=0):
+        """Implementation of distinct operation. Keys seen are kept in a hash set (a dict of the last rows for
+        keep='last'); when it outgrows memory_rows, the rows that may still be new are spilled to buckets on
+        disk by hash of keys and every bucket is deduplicated separately."""
+        context.print("_distinct using keys={}, keep={}, depth {}".format(keys, keep, depth))
+        memory_rows = memory_rows or DISTINCT_MEMORY_ROWS
+        spill = depth < DISTINCT_MAX_DEPTH
+        key = _distinct_key_function(keys)
+        table = iter(table)
+        if keep == 'first':
+            seen = set()
+            for line in table:
+                line_key = key(line)
+                if line_key in seen:
+                    continue
+                if spill and len(seen) >= memory_rows:
+                    rest = (line for line in itertools.chain([line], table) if key(line) not in seen)
+                    break
+                seen.add(line_key)
+                yield line
+            else:
+                return
+        else:
+            last = {}
+            for line in table:
+                line_key = key(line)
+                last.pop(line_key, None)
+                last[line_key] = line
+                if spill and len(last) > memory_rows:
+                    rest = itertools.chain(last.values(), table)
+                    break
+            else:
+                yield from last.values()
+                return
 
-    def _reduce(self, table, reducer, keys):
+        context.print("_distinct spills the table to {} buckets".format(DISTINCT_SPILL_BUCKETS))
+        bucket_of = lambda line: hash((depth, key(line))) % DISTINCT_SPILL_BUCKETS
+        with tempfile.TemporaryDirectory(prefix='mrop-distinct-') as directory:
+            filenames, counts, _ = _spill(rest, bucket_of, DISTINCT_SPILL_BUCKETS, directory, 'distinct')
+            context.event('spill', 'spill', operation='distinct', depth=depth, rows=sum(counts))
+            seen = last = None
+            for filename, count in zip(filenames, counts):
+                if count:
+                    yield from self._distinct(context, _read_spill(filename), keys, keep, memory_rows, depth + 1)
+
+    def _reduce(self, context, table, reducer, keys):
         """Implementation of reduce operation"""
-        # self._print("_reduce with reducer {} and keys {}".format(reducer, keys))
+        # context.print("_reduce with reducer {} and keys {}".format(reducer, keys))
         current_keys = None
         current_subtable = None
         for line in table:
-            # self._print("current_keys: {}, keys: {}, current_subtable: {}".format(
+            # context.print("current_keys: {}, keys: {}, current_subtable: {}".format(
             #     current_keys,
             #     self._getitems(line, keys),
             #     current_subtable)
@@ -338,15 +2127,17 @@ class ComputeGraph(object):
         table_keys = set(table_grouped.keys())
         on_keys = set(on_grouped.keys())
         keys_only_in_table = table_keys - on_keys
+        if not keys_only_in_table:
+            return
 
         first_line_table = table_grouped[next(iter(table_keys))][0]
-        first_line_on = on_grouped[next(iter(on_keys))][0]
-        none_fields = set(first_line_on.keys()) - set(first_line_table.keys())
-        # print('none_fields', none_fields)
-        # exit(1)
+        if on_keys:
+            first_line_on = on_grouped[next(iter(on_keys))][0]
+            none_fields = set(first_line_on.keys()) - set(first_line_table.keys())
+        else:
+            none_fields = set()
         for keys in keys_only_in_table:
             for line in table_grouped[keys]:
-                # print(line)
                 yield {**line, **{k : None for k in none_fields}}
 
     def _right_join_addition(self, table_grouped, on_grouped):
@@ -371,34 +2162,296 @@ class ComputeGraph(object):
             result[current_keys] = current_subtable
         return result
 
-    def _join(self, table, on, keys, strategy='inner'):
-        """Implementation of join operation. Tables should not have coincident keys except those that used to join."""
-        self._print("_join on {} with key {} and strategy {}".format(on, keys, strategy))
-        on.verbose = self.verbose
+    def _measure(self, table, n):
+        """Check whether the table has at most n lines, reading at most n + 1 of them.
+        Returns an iterator over the whole table and the answer."""
+        table = iter(table)
+        head = list(itertools.islice(table, n + 1))
+        return itertools.chain(head, table), len(head) <= n
+
+    def _hash_join(self, table, on, keys, strategy, build='on', fields=None):
+        """Join that loads the build side ('on' or 'table') into a dict and streams the other side through it.
+        Neither side is sorted, the output keeps the order of the streamed side.
+        fields -- pair of sets of fields of table and on lines, filled with None in unmatched lines.
+                  By default taken from the first line of each side"""
+        if build == 'on':
+            built, probe = on, table
+            keep_probe = strategy in ('left', 'outer')
+            keep_built = strategy in ('right', 'outer')
+            merge = lambda probe_line, built_line: {**built_line, **probe_line}
+            probe_fields, built_fields = fields or (None, None)
+        else:
+            built, probe = table, on
+            keep_probe = strategy in ('right', 'outer')
+            keep_built = strategy in ('left', 'outer')
+            merge = lambda probe_line, built_line: {**probe_line, **built_line}
+            built_fields, probe_fields = fields or (None, None)
+
+        built_grouped = {}
+        for line in built:
+            if built_fields is None:
+                built_fields = set(line.keys())
+            built_grouped.setdefault(self._getitems(line, keys), []).append(line)
+        built_fields = built_fields or set()
+
+        matched = set()
+        for line in probe:
+            if probe_fields is None:
+                probe_fields = set(line.keys())
+            line_keys = self._getitems(line, keys)
+            group = built_grouped.get(line_keys)
+            if group:
+                if keep_built:
+                    matched.add(line_keys)
+                for built_line in group:
+                    yield merge(line, built_line)
+            elif keep_probe:
+                yield {**line, **{k : None for k in built_fields - line.keys()}}
+
+        if keep_built:
+            for line_keys, group in built_grouped.items():
+                if line_keys not in matched:
+                    for line in group:
+                        yield {**line, **{k : None for k in (probe_fields or set()) - line.keys()}}
+
+    def _grace_join(self, context, table, on, keys, strategy, fields=None, depth=0, n_buckets=None):
+        """Join with bounded memory: both sides are hash partitioned into buckets on disk, then each pair
+        of buckets is joined by _hash_join, keeping only the smaller bucket in memory. Buckets with more than
+        JOIN_MEMORY_ROWS rows on both sides are partitioned again with another hash."""
+        n_buckets = n_buckets or GRACE_JOIN_BUCKETS
+        context.print("_grace_join with keys {}, depth {}, {} buckets".format(keys, depth, n_buckets))
+        bucket_of = lambda line: hash((depth, self._getitems(line, keys))) % n_buckets
+        with tempfile.TemporaryDirectory(prefix='mrop-join-') as directory:
+            table_files, table_counts, table_fields = _spill(table, bucket_of, n_buckets, directory, 'table')
+            on_files, on_counts, on_fields = _spill(on, bucket_of, n_buckets, directory, 'on')
+            context.event('spill', 'spill', operation='join', depth=depth,
+                          rows=sum(table_counts) + sum(on_counts), buckets=n_buckets)
+            fields = fields or (table_fields, on_fields)
+            for i in range(n_buckets):
+                if not table_counts[i] and not on_counts[i]:
+                    continue
+                table_bucket, on_bucket = _read_spill(table_files[i]), _read_spill(on_files[i])
+                if min(table_counts[i], on_counts[i]) > JOIN_MEMORY_ROWS and depth < GRACE_JOIN_MAX_DEPTH:
+                    yield from self._grace_join(context, table_bucket, on_bucket, keys, strategy, fields, depth + 1)
+                else:
+                    build = 'on' if on_counts[i] <= table_counts[i] else 'table'
+                    yield from self._hash_join(table_bucket, on_bucket, keys, strategy, build, fields)
+
+    def _index_join(self, table, index, keys, strategy):
+        """Join with an indexed file: for each line of the table only the matching lines of the file are
+        read and parsed. Right and outer joins read the rest of the file afterwards."""
+        if index.keys != tuple(keys):
+            raise ComputeGraphError('Index by {} used for join by {}'.format(index.keys, keys))
+        if index.offsets is None:
+            index.load()
+        keep_table = strategy in ('left', 'outer')
+        keep_on = strategy in ('right', 'outer')
+        with open(index.filename, 'rb') as file:
+            on_fields = None
+            for offsets in index.offsets.values():
+                file.seek(offsets[0])
+                on_fields = set(json.loads(file.readline()).keys())
+                break
+            on_fields = on_fields or set()
+
+            cache = {}
+            table_fields = None
+            for line in table:
+                if table_fields is None:
+                    table_fields = set(line.keys())
+                line_keys = self._getitems(line, keys)
+                if line_keys not in cache:
+                    cache[line_keys] = index.lines(line_keys, file)
+                if cache[line_keys]:
+                    for on_line in cache[line_keys]:
+                        yield {**on_line, **line}
+                elif keep_table:
+                    yield {**line, **{k : None for k in on_fields - line.keys()}}
 
+            if keep_on:
+                for line_keys in index.offsets:
+                    if line_keys not in cache:
+                        for line in index.lines(line_keys, file):
+                            yield {**line, **{k : None for k in (table_fields or set()) - line.keys()}}
+
+    def _sort_join(self, table, on, keys, strategy):
+        """Join that sorts both sides and groups them by keys"""
         table_grouped = self._group_by_keys(sorted(table, key=lambda line: self._getitems(line, keys)),keys)
         on_grouped = self._group_by_keys(sorted(on, key=lambda line: self._getitems(line, keys)), keys)
 
-        if strategy == 'inner':
-            yield from self._inner_join(table_grouped, on_grouped)
-        elif strategy == 'left':
-            yield from self._inner_join(table_grouped, on_grouped)
-            yield from self._left_join_addition(table_grouped, on_grouped)
-        elif strategy == 'right':
-            yield from self._inner_join(table_grouped, on_grouped)
-            yield from self._right_join_addition(table_grouped, on_grouped)
-        elif strategy == 'outer':
-            yield from self._inner_join(table_grouped, on_grouped)
+        yield from self._inner_join(table_grouped, on_grouped)
+        if strategy in ('left', 'outer'):
             yield from self._left_join_addition(table_grouped, on_grouped)
+        if strategy in ('right', 'outer'):
             yield from self._right_join_addition(table_grouped, on_grouped)
-        else:
+
+    def _join(self, context, table, on, keys, strategy='inner', algorithm='auto', stage=None, fields=None):
+        """Implementation of join operation. Tables should not have coincident keys except those that used to join.
+        stage is the index of the table stage in the graph, to find its statistics.
+        fields is a pair of sets of fields of table and on lines to fill unmatched lines with, given by
+        DistributedExecutor for joins of buckets: the join is done by hash or grace join then."""
+        context.print("_join on {} with key {}, strategy {} and algorithm {}".format(on, keys, strategy, algorithm))
+        if strategy not in JOIN_STRATEGIES:
             raise ValueError('Unknown strategy for join')
+        if fields is not None and algorithm not in ('broadcast', 'hash', 'grace'):
+            algorithm = 'hash'
+
+        if algorithm == 'index' or (algorithm == 'auto' and isinstance(on, JsonLinesIndex)):
+            yield from self._index_join(table, self._index_of(on, keys), keys, strategy)
+        elif algorithm == 'broadcast':
+            yield from self._hash_join(table, context.rows(on), keys, strategy, build='on', fields=fields)
+        elif algorithm == 'hash':
+            table_statistics, on_statistics = self._join_statistics(context, stage, on)
+            build = 'on'
+            if table_statistics and on_statistics and table_statistics['rows'] < on_statistics['rows']:
+                build = 'table'
+            yield from self._hash_join(table, context.rows(on), keys, strategy, build=build, fields=fields)
+        elif algorithm == 'sort':
+            yield from self._sort_join(table, context.rows(on), keys, strategy)
+        elif algorithm == 'grace':
+            yield from self._grace_join(context, table, context.rows(on), keys, strategy, fields)
+        elif algorithm == 'auto':
+            yield from self._auto_join(context, table, on, keys, strategy, stage)
+        else:
+            raise ValueError('Unknown algorithm for join')
+
+    def _indexed_source(self, on, keys):
+        """Whether 'on' is a graph without operations reading a single file, that has a valid index by keys"""
+        return (isinstance(on, ComputeGraph) and bool(keys) and not on.operations
+                and on.source == on._parse_file and len(on.source_filenames) == 1
+                and detect_compression(on.source_filenames[0]) is None
+                and JsonLinesIndex(on.source_filenames[0], keys).is_valid())
+
+    def _index_of(self, on, keys):
+        """Index to join with 'on' by keys: 'on' itself or the index of the file read by 'on'"""
+        if isinstance(on, JsonLinesIndex):
+            return on
+        if (isinstance(on, ComputeGraph) and not on.operations
+                and on.source == on._parse_file and len(on.source_filenames) == 1):
+            return build_index(on.source_filenames[0], keys)
+        raise ComputeGraphError('Index join needs an index or a graph reading a single file without operations')
+
+    def _join_statistics(self, context, stage, on):
+        """Statistics of the table (the stage of this graph) and of 'on' from previous runs, None if unknown"""
+        if context.statistics is None or stage is None:
+            return None, None
+        fingerprints = context.stage_fingerprints(self)
+        table_statistics = fingerprints and context.statistics.get(fingerprints[stage])
+        on_statistics = None
+        if isinstance(on, ComputeGraph):
+            on_fingerprints = context.stage_fingerprints(on)
+            on_statistics = on_fingerprints and context.statistics.get(on_fingerprints[-1])
+        elif hasattr(on, '__len__'):
+            on_statistics = {'rows' : len(on)}
+        return table_statistics, on_statistics
+
+    def _sorted_by(self, graph, stage, keys):
+        """Whether the stage of the graph is sorted by keys (so that sorting it again is linear)"""
+        if not isinstance(graph, ComputeGraph) or not stage:
+            return False
+        operation = graph.operations[stage - 1]
+        return operation[0] == '_sort' and tuple(operation[1][:len(keys)]) == tuple(keys)
+
+    def _choose_join(self, table_statistics, on_statistics, table_sorted, on_sorted, build_distinct=None):
+        """Cost based choice of the join algorithm and the side to build the hash table on.
+        Returns (algorithm, build side, number of buckets for grace join)."""
+        statistics = {'table' : table_statistics, 'on' : on_statistics}
+        rows = {side : statistics[side]['rows'] for side in statistics}
+        build = 'on' if rows['on'] <= rows['table'] else 'table'
+        probe = 'table' if build == 'on' else 'on'
+        if rows[build] <= BROADCAST_JOIN_ROWS:
+            return 'broadcast', build, None
+
+        build_bytes = rows[build] * statistics[build].get('row_bytes', 0)
+        if rows[build] > JOIN_MEMORY_ROWS or build_bytes > JOIN_MEMORY_BYTES:
+            n_buckets = max(GRACE_JOIN_BUCKETS,
+                            2 * math.ceil(rows[build] / JOIN_MEMORY_ROWS),
+                            2 * math.ceil(build_bytes / JOIN_MEMORY_BYTES))
+            if build_distinct:
+                n_buckets = min(n_buckets, build_distinct)
+            return 'grace', build, max(1, min(n_buckets, GRACE_JOIN_MAX_BUCKETS))
+
+        hash_cost = HASH_JOIN_BUILD_COST * rows[build] + rows[probe]
+        sort_cost = sum(
+            n if already_sorted else n * math.log2(max(n, 2))
+            for n, already_sorted in ((rows['table'], table_sorted), (rows['on'], on_sorted))
+        )
+        if max(rows.values()) <= JOIN_MEMORY_ROWS and sort_cost < hash_cost:
+            return 'sort', build, None
+        return 'hash', build, None
+
+    def _planned_join(self, context, table, on, keys, strategy, stage):
+        """Join by the algorithm chosen by _choose_join from statistics of previous runs.
+        Returns None if there are no statistics for both sides."""
+        table_statistics, on_statistics = self._join_statistics(context, stage, on)
+        if not table_statistics or not on_statistics:
+            return None
+        build_distinct = None
+        if isinstance(on, ComputeGraph) and on_statistics['rows'] <= table_statistics['rows']:
+            on_fingerprints = context.stage_fingerprints(on)
+            build_distinct = on_fingerprints and context.statistics.distinct(on_fingerprints[-1], keys)
+        elif table_statistics['rows'] < on_statistics['rows']:
+            build_distinct = context.statistics.distinct(context.stage_fingerprints(self)[stage], keys)
+        algorithm, build, n_buckets = self._choose_join(
+            table_statistics, on_statistics,
+            self._sorted_by(self, stage, keys),
+            isinstance(on, ComputeGraph) and self._sorted_by(on, len(on.operations), keys),
+            build_distinct
+        )
+        context.print("_join planned by statistics: algorithm {}, build side {}".format(algorithm, build))
+        on = context.rows(on)
+        if algorithm in ('broadcast', 'hash'):
+            return self._hash_join(table, on, keys, strategy, build=build)
+        if algorithm == 'sort':
+            return self._sort_join(table, on, keys, strategy)
+        return self._grace_join(context, table, on, keys, strategy, n_buckets=n_buckets)
+
+    def _auto_join(self, context, table, on, keys, strategy, stage=None):
+        """Choose join algorithm by what is known about sizes of the sides"""
+        if self._indexed_source(on, keys):
+            table, table_small = self._measure(table, BROADCAST_JOIN_ROWS)
+            if table_small:
+                context.print("_join looks up the table in the index of", on.source_filenames[0])
+                yield from self._index_join(table, self._index_of(on, keys), keys, strategy)
+                return
+        planned = self._planned_join(context, table, on, keys, strategy, stage)
+        if planned is not None:
+            yield from planned
+            return
+        on = context.rows(on)
+        if hasattr(on, '__len__') and len(on) <= BROADCAST_JOIN_ROWS:
+            yield from self._hash_join(table, on, keys, strategy, build='on')
+            return
+        on, on_small = self._measure(on, BROADCAST_JOIN_ROWS)
+        if on_small:
+            context.print("_join broadcasts 'on'")
+            yield from self._hash_join(table, on, keys, strategy, build='on')
+            return
+        table, table_small = self._measure(table, BROADCAST_JOIN_ROWS)
+        if table_small:
+            context.print("_join broadcasts the table")
+            yield from self._hash_join(table, on, keys, strategy, build='table')
+            return
+        on, on_fits = self._measure(on, JOIN_MEMORY_ROWS)
+        table, table_fits = self._measure(table, JOIN_MEMORY_ROWS)
+        if on_fits and table_fits:
+            yield from self._sort_join(table, on, keys, strategy)
+        else:
+            context.print("_join spills to disk")
+            yield from self._grace_join(context, table, on, keys, strategy)
+
+    def save_columnar(self, dirname):
+        """Saves the result to dirname in the columnar format, to be read back by ColumnarTable"""
+        if not self.result:
+            raise ComputeGraphError('The graph is not computed')
+        write_columnar(self.result, dirname)
 
     def save_to_file(self, filename):
-        """Saves the result to file, each row from the table to json-like string, ended with '\n' """
+        """Saves the result to file, each row from the table to json-like string, ended with '\n'.
+        The file is compressed if filename ends with '.gz', '.bz2' or '.xz'"""
         if not self.result:
             raise ComputeGraphError('The graph is not computed')
         else:
-            with open(filename, 'w') as file:
+            with open_file(filename, 'w') as file:
                 for line in self.result:
                     file.write(str(line) + '\n')
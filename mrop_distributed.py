@@ -0,0 +1,545 @@
+"""Distributed execution of compute graphs (mrop.ComputeGraph).
+
+A coordinator (DistributedExecutor) splits a finalized graph into tasks. Narrow operations (map) run on the
+partitions of the source, while sort + reduce, gathering reduce, fold, distinct and join shuffle the rows into
+buckets. A fold with a merge function folds every partition first and shuffles only the partial states.
+A sort followed by reduces partitions the rows by the keys all those reduces share, and the buckets of the
+result are merged by the sort keys when collected, so that the result is ordered as a local run would order
+it, as long as the reducers keep those keys in their output lines (otherwise buckets are concatenated).
+Every task is a pickled chain of operations together with a description of its input, and it is sent to one
+of the worker processes over TCP. Workers keep the outputs of their tasks in memory and fetch the buckets
+they need directly from each other.
+
+When a worker dies, the tasks whose outputs were stored there are run again on the remaining workers, using
+the same task descriptions (lineage).
+
+Example of usage:
+
+    with mrop_distributed.LocalCluster(4) as cluster:
+        executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+        result = word_count.run(executor=executor)
+
+Workers on other machines are started with
+
+    MROP_AUTHKEY=secret python mrop_distributed.py HOST PORT
+
+and the coordinator is run with the same MROP_AUTHKEY. Messages are pickled, and unpickling runs code, so
+every message is signed with HMAC by that shared secret and a message with a wrong signature is dropped
+unread. Without MROP_AUTHKEY a process makes up a random secret, which is shared only with the workers of
+a LocalCluster it forks. Messages are not encrypted: on an untrusted network, run workers behind a tunnel.
+
+All functions used by the graph (mappers, reducers, folders) should be importable by the workers.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import traceback
+import zlib
+
+import mrop
+
+
+CONNECT_TIMEOUT = 5
+HEADER = struct.Struct('!Q')
+AUTHKEY = os.environ.get('MROP_AUTHKEY', '').encode() or os.urandom(32)
+
+
+class _Unauthenticated(ConnectionError):
+    """The message is not signed by the shared secret"""
+    pass
+
+
+def _signature(authkey, data):
+    """HMAC of the data by the shared secret"""
+    return hmac.new(authkey, data, hashlib.sha256).digest()
+
+
+def _send(sock, message, authkey):
+    """Send a pickled message prefixed with its length and its signature"""
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + _signature(authkey, data) + data)
+
+
+def _recv_exactly(sock, size):
+    """Receive exactly size bytes from the socket"""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('Connection closed by the other side')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv(sock, authkey):
+    """Receive a message sent by _send, unpickling it only if it is signed by authkey"""
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    signature = _recv_exactly(sock, hashlib.sha256().digest_size)
+    data = _recv_exactly(sock, size)
+    if not hmac.compare_digest(signature, _signature(authkey, data)):
+        raise _Unauthenticated('Message is not signed by the shared secret')
+    return pickle.loads(data)
+
+
+def _request(address, message, authkey, timeout=None):
+    """Send a message to the worker at address and return its reply"""
+    with socket.create_connection(address, timeout=CONNECT_TIMEOUT) as sock:
+        sock.settimeout(timeout)
+        _send(sock, message, authkey)
+        return _recv(sock, authkey)
+
+
+def _bucket(line, keys, n_buckets):
+    """Bucket of the line, the same in all processes (unlike hash() of strings)"""
+    return zlib.crc32(repr(tuple(line[k] for k in keys)).encode()) % n_buckets
+
+
+class _PeerLost(Exception):
+    """Output of a task could not be fetched from another worker"""
+    def __init__(self, address):
+        super().__init__(address)
+        self.address = address
+
+
+class Worker(object):
+    """TCP server that runs tasks sent by the coordinator and serves their outputs to other workers"""
+
+    def __init__(self, host='127.0.0.1', port=0, authkey=None):
+        self.outputs = {}
+        self.authkey = authkey or AUTHKEY
+        self.lock = threading.Lock()
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    message = _recv(self.request, worker.authkey)
+                except ConnectionError:
+                    return
+                _send(self.request, worker.handle(message), worker.authkey)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.address = self.server.server_address[:2]
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def handle(self, message):
+        """Process one request: ('run', task), ('fetch', task_id, bucket), ('drop', job_id) or ('shutdown',)"""
+        kind = message[0]
+        if kind == 'run':
+            try:
+                fields = self._run(message[1])
+            except _PeerLost as error:
+                return ('lost', error.address)
+            except Exception:
+                return ('error', traceback.format_exc())
+            return ('ok', fields)
+        elif kind == 'fetch':
+            with self.lock:
+                buckets = self.outputs.get(message[1])
+            if buckets is None:
+                return ('missing',)
+            return ('ok', buckets[message[2]])
+        elif kind == 'drop':
+            with self.lock:
+                for task_id in [task_id for task_id in self.outputs if task_id[0] == message[1]]:
+                    del self.outputs[task_id]
+            return ('ok',)
+        elif kind == 'shutdown':
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return ('ok',)
+        return ('error', 'Unknown request {}'.format(kind))
+
+    def _fetch(self, address, task_id, bucket):
+        """Rows of a bucket of the task output stored at address"""
+        if tuple(address) == tuple(self.address):
+            reply = self.handle(('fetch', task_id, bucket))
+        else:
+            try:
+                reply = _request(address, ('fetch', task_id, bucket), self.authkey)
+            except OSError:
+                raise _PeerLost(address)
+        if reply[0] != 'ok':
+            raise _PeerLost(address)
+        return reply[1]
+
+    def _read(self, spec):
+        """Rows described by an input spec: ('rows', rows), ('file', filename) or ('fetch', sources, bucket)"""
+        if spec[0] == 'rows':
+            return spec[1]
+        elif spec[0] == 'file':
+            return mrop._read_partition(spec[1])
+        rows = []
+        for address, task_id in spec[1]:
+            rows.extend(self._fetch(address, task_id, spec[2]))
+        return rows
+
+    def _run(self, task):
+        """Run the operations of the task on its input and store the output, bucketed if needed.
+        Returns fields of the first line of the output, None if it is empty."""
+        graph = mrop.ComputeGraph(source=self._read(task['input']))
+        for operation in task['operations']:
+            if operation[0] == '_join':
+                operation = (operation[0], self._read(operation[1])) + tuple(operation[2:])
+            graph.operations.append(operation)
+        graph.finalize()
+
+        output = task['output']
+        fields = None
+        if output[0] == 'single':
+            buckets = [list(graph)]
+            if buckets[0]:
+                fields = set(buckets[0][0].keys())
+        else:
+            n_buckets, keys = output[1:]
+            buckets = [[] for _ in range(n_buckets)]
+            for line in graph:
+                if fields is None:
+                    fields = set(line.keys())
+                buckets[_bucket(line, keys, n_buckets)].append(line)
+        with self.lock:
+            self.outputs[task['id']] = buckets
+        return fields
+
+
+def serve(host='127.0.0.1', port=0, ready=None, authkey=None):
+    """Start a worker and serve until shutdown. The address of the worker is sent to the ready pipe"""
+    worker = Worker(host, port, authkey)
+    if ready is not None:
+        ready.send(worker.address)
+        ready.close()
+    worker.serve_forever()
+
+
+class LocalCluster(object):
+    """Workers in local processes, for tests and for using all cores of one machine"""
+
+    def __init__(self, n_workers, host='127.0.0.1', authkey=None):
+        context = multiprocessing.get_context('fork')
+        self.authkey = authkey or AUTHKEY
+        self.processes = []
+        self.addresses = []
+        for _ in range(n_workers):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=serve, args=(host, 0, sender, self.authkey), daemon=True)
+            process.start()
+            self.addresses.append(tuple(receiver.recv()))
+            self.processes.append(process)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Fetch(object):
+    """Input made of one bucket of the outputs of several tasks"""
+    def __init__(self, tasks, bucket):
+        self.tasks = tasks
+        self.bucket = bucket
+
+
+class _Fields(object):
+    """Fields of the first lines of both sides of a join, taken from the tasks shuffling them. Every bucket
+    of a join fills unmatched lines with the same fields, as a join on one machine does."""
+    def __init__(self, table_tasks, on_tasks):
+        self.table_tasks = table_tasks
+        self.on_tasks = on_tasks
+
+
+class _Task(object):
+    """Task description kept by the coordinator, enough to rerun it after a worker failure"""
+    def __init__(self, task_id, input, operations, output):
+        self.id = task_id
+        self.input = input
+        self.operations = operations
+        self.output = output
+        self.location = None
+        self.fields = None
+        self.lock = threading.Lock()
+
+    def upstream(self):
+        """Tasks whose outputs are read by this task"""
+        fetches = [self.input] + [operation[1] for operation in self.operations if operation[0] == '_join']
+        return [task for fetch in fetches if isinstance(fetch, _Fetch) for task in fetch.tasks]
+
+
+class DistributedExecutor(object):
+    """Coordinator running compute graphs on workers (see the module docstring)"""
+
+    def __init__(self, addresses, n_buckets=None, max_attempts=3, task_timeout=None, authkey=None):
+        """
+        Keyword arguments:
+        addresses       -- list of (host, port) of the workers
+        n_buckets       -- number of buckets in shuffles by non-empty keys (default: number of workers)
+        max_attempts    -- how many times a task is tried on different workers before giving up
+        task_timeout    -- seconds to wait for a task to finish on a worker (default: no limit)
+        authkey         -- bytes with the secret shared with the workers (default: AUTHKEY, see the module
+                           docstring)
+        """
+        if not addresses:
+            raise mrop.ComputeGraphError('No workers given')
+        self.addresses = [tuple(address) for address in addresses]
+        self.n_buckets = n_buckets or len(self.addresses)
+        self.max_attempts = max_attempts
+        self.task_timeout = task_timeout
+        self.authkey = authkey or AUTHKEY
+        self.dead = set()
+        self.lock = threading.Lock()
+        self._jobs = itertools.count()
+        self._workers = itertools.cycle(self.addresses)
+
+    def run(self, graph):
+        """Evaluate the graph on the workers and return its result as a list"""
+        job_id = next(self._jobs)
+        self._job = job_id
+        self._task_ids = itertools.count()
+        self._compiled = {}
+        self._orders = {}
+        tasks = self._compile(graph)
+        try:
+            self._materialize(tasks)
+            outputs = [self._collect(task) for task in tasks]
+            order = self._orders[id(graph)]
+            if order and all(key in line for output in outputs for line in output for key in order):
+                return list(heapq.merge(*outputs, key=mrop._key_function(order)))
+            return [line for output in outputs for line in output]
+        finally:
+            for address in self._live():
+                try:
+                    _request(address, ('drop', job_id), self.authkey)
+                except OSError:
+                    self._mark_dead(address)
+
+    def shutdown(self):
+        """Stop all workers"""
+        for address in self._live():
+            try:
+                _request(address, ('shutdown',), self.authkey)
+            except OSError:
+                pass
+
+    def _live(self):
+        with self.lock:
+            return [address for address in self.addresses if address not in self.dead]
+
+    def _mark_dead(self, address):
+        with self.lock:
+            self.dead.add(tuple(address))
+
+    def _next_worker(self):
+        with self.lock:
+            if len(self.dead) == len(self.addresses):
+                raise mrop.ComputeGraphError('All workers are dead')
+            while True:
+                address = next(self._workers)
+                if address not in self.dead:
+                    return address
+
+    def _task(self, partition, output):
+        """Register a task computing the partition, a pair [input, operations]"""
+        task_id = (self._job, next(self._task_ids))
+        return _Task(task_id, partition[0], list(partition[1]), output)
+
+    def _shuffle(self, partitions, keys, n_buckets):
+        """Finish the partitions with tasks bucketing their rows by keys, return partitions reading the buckets"""
+        tasks = [self._task(partition, ('buckets', n_buckets, keys)) for partition in partitions]
+        return [[_Fetch(tasks, bucket), []] for bucket in range(n_buckets)]
+
+    def _split_rows(self, rows):
+        """Partitions of an in-memory source, one contiguous chunk per worker"""
+        rows = list(rows)
+        n = max(1, min(len(self.addresses), len(rows)))
+        size = -(-len(rows) // n)
+        return [[('rows', rows[i * size:(i + 1) * size]), []] for i in range(n)]
+
+    def _compile(self, graph):
+        """Tasks producing the result of the graph, one partition of the result per task in order"""
+        if id(graph) in self._compiled:
+            return self._compiled[id(graph)]
+        if not graph.finalized:
+            raise mrop.ComputeGraphError('Run of a nonfinalized graph')
+        if not graph.source:
+            raise mrop.ComputeGraphError('Source not specified')
+
+        if graph.source == graph._parse_file:
+            partitions = [[('file', filename), []] for filename in graph.source_filenames]
+        elif isinstance(graph.source_data, mrop.ComputeGraph):
+            partitions = [[_Fetch([task], 0), []] for task in self._compile(graph.source_data)]
+        else:
+            partitions = self._split_rows(graph.source_data)
+
+        operations = graph.operations
+        partitioned_by = None
+        grouped = False
+        order = None
+        for index, operation in enumerate(operations):
+            name = operation[0]
+            if name == '_map':
+                grouped = False
+                order = None
+            elif name == '_sort':
+                # workers are daemonic processes, which can not start sorting processes of their own
+                operation = operation[:2] + (1,)
+                # partition by the keys shared by all the reduces following the sort, so that every group
+                # of each of them is in one bucket
+                reduces = list(itertools.takewhile(lambda following: following[0] == '_reduce', operations[index + 1:]))
+                partitioned_by = ()
+                if reduces:
+                    partitioned_by = tuple(key for key in reduces[0][2] or ()
+                                           if all(key in (following[2] or ()) for following in reduces))
+                if partitioned_by:
+                    partitions = self._shuffle(partitions, partitioned_by, self.n_buckets)
+                    grouped = True
+                    order = tuple(itertools.takewhile(partitioned_by.__contains__, operation[1])) or None
+                else:
+                    partitions = self._shuffle(partitions, (), 1)
+                    grouped = False
+                    order = None
+            elif name == '_reduce':
+                if not (grouped and partitioned_by and set(partitioned_by) <= set(operation[2])):
+                    partitions = self._shuffle(partitions, (), 1)
+                    grouped = False
+                    order = None
+            elif name == '_distinct':
+                keys = tuple(operation[1] or ())
+                partitions = self._shuffle(partitions, keys, self.n_buckets if keys else 1)
+                grouped = False
+                order = None
+            elif name == '_fold' and len(operation) > 3:
+                for partition in partitions:
+                    partition[1].append(operation[:4] + (1,))
+                partitions = self._shuffle(partitions, (), 1)
+                partitions[0][1].append(('_merge_folds', operation[3], operation[2]))
+                grouped = False
+                order = None
+                continue
+            elif name == '_fold':
+                partitions = self._shuffle(partitions, (), 1)
+                grouped = False
+                order = None
+            elif name == '_join':
+                on, keys, algorithm = operation[1], tuple(operation[2]), operation[4]
+                if isinstance(on, mrop.ComputeGraph):
+                    on_partitions = [[_Fetch([task], 0), []] for task in self._compile(on)]
+                elif isinstance(on, mrop.JsonLinesIndex):
+                    on_partitions = [[('file', on.filename), []]]
+                else:
+                    on_partitions = self._split_rows(on)
+                if algorithm == 'index':
+                    # buckets of 'on' are fetched to the workers, there is no indexed file to look lines up in
+                    algorithm = 'hash'
+                n_buckets = self.n_buckets if keys else 1
+                partitions = self._shuffle(partitions, keys, n_buckets)
+                on_partitions = self._shuffle(on_partitions, keys, n_buckets)
+                fields = _Fields(partitions[0][0].tasks, on_partitions[0][0].tasks)
+                for partition, on_partition in zip(partitions, on_partitions):
+                    partition[1].append((name, on_partition[0], keys, operation[3], algorithm, operation[5], fields))
+                grouped = False
+                order = None
+                continue
+            else:
+                raise mrop.ComputeGraphError('Operation {} is not supported by DistributedExecutor'.format(name))
+            for partition in partitions:
+                partition[1].append(operation)
+
+        tasks = [self._task(partition, ('single',)) for partition in partitions]
+        self._compiled[id(graph)] = tasks
+        self._orders[id(graph)] = order
+        return tasks
+
+    def _materialize(self, tasks):
+        """Make sure outputs of all tasks are stored on live workers, running tasks in parallel"""
+        if len(tasks) <= 1:
+            for task in tasks:
+                self._ensure(task)
+            return
+        with concurrent.futures.ThreadPoolExecutor(min(len(tasks), 4 * len(self.addresses))) as executor:
+            for future in [executor.submit(self._ensure, task) for task in tasks]:
+                future.result()
+
+    def _resolve(self, spec):
+        """Replace tasks in the input spec by the locations of their outputs, and _Fields by the fields"""
+        if isinstance(spec, _Fetch):
+            return ('fetch', [(task.location, task.id) for task in spec.tasks], spec.bucket)
+        if isinstance(spec, _Fields):
+            return tuple(next((task.fields for task in tasks if task.fields is not None), set())
+                         for tasks in (spec.table_tasks, spec.on_tasks))
+        return spec
+
+    def _ensure(self, task):
+        """Run the task unless its output is on a live worker. Lost upstream outputs are recomputed first"""
+        with task.lock:
+            attempts = 0
+            while task.location is None or task.location in self.dead:
+                if attempts == self.max_attempts:
+                    raise mrop.ComputeGraphError('Task {} failed {} times'.format(task.id, attempts))
+                attempts += 1
+                self._materialize(task.upstream())
+                address = self._next_worker()
+                message = ('run', {
+                    'id' : task.id,
+                    'input' : self._resolve(task.input),
+                    'operations' : [
+                        tuple(self._resolve(item) for item in operation)
+                        if operation[0] == '_join' else operation
+                        for operation in task.operations
+                    ],
+                    'output' : task.output,
+                })
+                try:
+                    reply = _request(address, message, self.authkey, timeout=self.task_timeout)
+                except OSError:
+                    self._mark_dead(address)
+                    continue
+                if reply[0] == 'ok':
+                    task.fields = reply[1]
+                    task.location = address
+                elif reply[0] == 'lost':
+                    self._mark_dead(reply[1])
+                else:
+                    raise mrop.ComputeGraphError('Task {} failed on {}:\n{}'.format(task.id, address, reply[1]))
+
+    def _collect(self, task):
+        """Fetch the output of a final task to the coordinator"""
+        while True:
+            self._ensure(task)
+            try:
+                reply = _request(task.location, ('fetch', task.id, 0), self.authkey)
+            except OSError:
+                reply = ('missing',)
+            if reply[0] == 'ok':
+                return reply[1]
+            self._mark_dead(task.location)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start a compute graph worker')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    args = parser.parse_args()
+    if not os.environ.get('MROP_AUTHKEY'):
+        parser.error('MROP_AUTHKEY environment variable should hold the secret shared with the coordinator')
+    serve(args.host, args.port)
@@ -0,0 +1,243 @@
+import pytest
+import os
+import sys
+import json
+import re
+from collections import Counter
+
+
+parentPath = os.path.abspath("../")
+if parentPath not in sys.path:
+    sys.path.insert(0, parentPath)
+
+import mrop
+import mrop_distributed
+
+
+texts = [
+    {'doc_id' : 1, 'text' : 'hello world hello'},
+    {'doc_id' : 2, 'text' : 'little world of graphs'},
+    {'doc_id' : 3, 'text' : 'hello little graphs'},
+]
+
+
+def words_mapper(line):
+    for word in re.findall('[a-z]+', line['text']):
+        yield {'doc_id' : line['doc_id'], 'word' : word}
+
+
+def count_reducer(table):
+    yield {'word' : table[0]['word'], 'count' : len(table)}
+
+
+def docs_counter(line, initial):
+    return {'docs' : initial['docs'] + 1}
+
+
+def total_reducer(table):
+    yield {'total' : len(table)}
+
+
+def dying_mapper(line):
+    try:
+        os.close(os.open(os.environ['MROP_TEST_MARKER'], os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        yield line
+        return
+    os._exit(1)
+
+
+def build_graphs(source):
+    words = mrop.ComputeGraph(source=source)
+    words.map(words_mapper)
+    words.finalize()
+
+    counts = mrop.ComputeGraph(source=words)
+    counts.sort(('word',))
+    counts.reduce(count_reducer, keys=('word',))
+    counts.join(on=words, keys=('word',), strategy='inner')
+    counts.finalize()
+
+    docs = mrop.ComputeGraph(source=source)
+    docs.fold(docs_counter, {'docs' : 0})
+    docs.finalize()
+
+    total = mrop.ComputeGraph(source=words)
+    total.reduce(total_reducer, keys=tuple())
+    total.join(on=docs, keys=tuple(), strategy='outer')
+    total.finalize()
+    return counts, total
+
+
+def canonical(table):
+    return sorted(json.dumps(line, sort_keys=True) for line in table)
+
+
+@pytest.fixture
+def cluster():
+    with mrop_distributed.LocalCluster(3) as cluster:
+        yield cluster
+
+
+def test_same_result_as_local_run(cluster):
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    for local, distributed in zip(build_graphs(texts), build_graphs(texts)):
+        assert canonical(distributed.run(executor=executor)) == canonical(local.run())
+
+
+def test_sort_is_global(cluster):
+    graph = mrop.ComputeGraph(source=texts)
+    graph.map(words_mapper)
+    graph.sort(('word', 'doc_id'))
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    result = executor.run(graph)
+    assert [(line['word'], line['doc_id']) for line in result] == sorted(
+        (line['word'], line['doc_id']) for line in result)
+
+
+def count_reducer_by_a(table):
+    yield {'a' : table[0]['a'], 'count' : len(table)}
+
+
+def pair_reducer(table):
+    yield {'a' : table[0]['a'], 'b' : table[0]['b'], 'n' : len(table)}
+
+
+def groups_reducer(table):
+    yield {'a' : table[0]['a'], 'groups' : len(table)}
+
+
+def test_reduces_with_narrowing_keys(cluster):
+    graph = mrop.ComputeGraph(source=[{'a' : i % 5, 'b' : i % 7} for i in range(200)])
+    graph.sort(('a', 'b'))
+    graph.reduce(pair_reducer, ('a', 'b'))
+    graph.reduce(groups_reducer, ('a',))
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert executor.run(graph) == graph.evaluate() == [{'a' : a, 'groups' : 7} for a in range(5)]
+
+
+def test_reduce_result_is_ordered(cluster):
+    graph = mrop.ComputeGraph(source=[{'a' : (i * 7919) % 50} for i in range(300)])
+    graph.sort(('a',))
+    graph.reduce(count_reducer_by_a, ('a',))
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert executor.run(graph) == graph.evaluate()
+
+
+def test_parallel_sort_runs_sequentially_on_workers(monkeypatch):
+    monkeypatch.setattr(mrop, 'PARALLEL_SORT_MIN_LINES', 10)
+    graph = mrop.ComputeGraph(source=[{'a' : (i * 7919) % 101} for i in range(300)])
+    graph.sort(('a',), n_workers=2)
+    graph.finalize()
+    with mrop_distributed.LocalCluster(2) as cluster:
+        executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+        assert executor.run(graph) == graph.evaluate()
+
+
+class FileCreator(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __reduce__(self):
+        return (open, (self.filename, 'w'))
+
+
+def test_unsigned_message_is_not_unpickled(cluster, tmpdir):
+    filename = str(tmpdir.join('created'))
+    with pytest.raises(ConnectionError):
+        mrop_distributed._request(cluster.addresses[0], ('run', FileCreator(filename)), b'wrong secret')
+    assert not os.path.exists(filename)
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert executor.run(mrop.ComputeGraph(source=texts).finalize()) == texts
+
+
+def test_file_partitions(cluster, tmpdir):
+    for line in texts:
+        with open(str(tmpdir.join('{}.json'.format(line['doc_id']))), 'w') as file:
+            file.write(json.dumps(line) + '\n')
+    local, _ = build_graphs(texts)
+    distributed, _ = build_graphs(str(tmpdir))
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert canonical(executor.run(distributed)) == canonical(local.run())
+
+
+def test_worker_failure(tmpdir, monkeypatch):
+    monkeypatch.setenv('MROP_TEST_MARKER', str(tmpdir.join('died')))
+
+    words = mrop.ComputeGraph(source=texts)
+    words.map(words_mapper)
+    words.finalize()
+    counts = mrop.ComputeGraph(source=words)
+    counts.map(dying_mapper)
+    counts.sort(('word',))
+    counts.reduce(count_reducer, keys=('word',))
+    counts.finalize()
+
+    with mrop_distributed.LocalCluster(3) as cluster:
+        executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+        result = executor.run(counts)
+        assert len(executor.dead) == 1
+    assert canonical(result) == canonical([
+        {'word' : 'graphs', 'count' : 2},
+        {'word' : 'hello', 'count' : 3},
+        {'word' : 'little', 'count' : 2},
+        {'word' : 'of', 'count' : 1},
+        {'word' : 'world', 'count' : 2},
+    ])
+
+
+def test_user_error_is_reported(cluster):
+    graph = mrop.ComputeGraph(source=[{'text' : 1}])
+    graph.map(words_mapper)
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    with pytest.raises(mrop.ComputeGraphError):
+        executor.run(graph)
+
+
+def test_distinct(cluster):
+    graph = mrop.ComputeGraph(source=texts)
+    graph.map(words_mapper)
+    graph.distinct(keys=('word',))
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    result = executor.run(graph)
+    assert sorted(line['word'] for line in result) == ['graphs', 'hello', 'little', 'of', 'world']
+
+
+def count_merge(left, right):
+    return {'docs' : left['docs'] + right['docs']}
+
+
+def test_fold_with_merge(cluster):
+    graph = mrop.ComputeGraph(source=texts * 5)
+    graph.fold(docs_counter, {'docs' : 0}, merge=count_merge)
+    graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert executor.run(graph) == [{'docs' : 15}]
+
+
+@pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+def test_join_with_sparse_matches(cluster, strategy):
+    def build():
+        graph = mrop.ComputeGraph(source=[{'id' : i, 'name' : 'name' + str(i)} for i in range(6)])
+        graph.join(on=[{'id' : 4, 'city' : 'Moscow'}, {'id' : 9, 'city' : 'Paris'}], keys=('id',), strategy=strategy)
+        return graph.finalize()
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    assert canonical(executor.run(build())) == canonical(build().run())
+
+
+def test_index_join(cluster, tmpdir):
+    filename = str(tmpdir.join('cities.json'))
+    with open(filename, 'w') as file:
+        for i in (1, 3, 9):
+            file.write(json.dumps({'id' : i, 'city' : 'city' + str(i)}) + '\n')
+    executor = mrop_distributed.DistributedExecutor(cluster.addresses)
+    for on in (mrop.ComputeGraph(source=filename).finalize(), mrop.build_index(filename, ('id',))):
+        graph = mrop.ComputeGraph(source=[{'id' : i} for i in range(6)])
+        graph.join(on=on, keys=('id',), strategy='left', algorithm='index')
+        graph.finalize()
+        assert canonical(executor.run(graph)) == canonical(graph.evaluate())
@@ -3,6 +3,8 @@ import os
 import sys
 import json
 import ast
+import re
+from collections import Counter
 
 
 parentPath = os.path.abspath("../")
@@ -145,3 +147,861 @@ def test_topological_sort_and_dependecies():
 
 
 
+
+
+def run_join(table, on, keys, strategy, algorithm):
+    graph = mrop.ComputeGraph(source=table)
+    graph.join(on=on, keys=keys, strategy=strategy, algorithm=algorithm)
+    graph.finalize()
+    return sorted(graph.run(), key=lambda line: sorted((k, str(v)) for k, v in line.items()))
+
+
+class TestBroadcastJoin:
+    @pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+    def test_same_as_sort_join(self, strategy):
+        names_list = list(names)
+        cities_list = list(cities)
+        expected = run_join(names_list, cities_list, ('id',), strategy, 'sort')
+        assert run_join(names_list, cities_list, ('id',), strategy, 'broadcast') == expected
+        assert run_join(names_list, cities_list, ('id',), strategy, 'auto') == expected
+
+    @pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+    def test_broadcast_of_small_table_side(self, strategy, monkeypatch):
+        monkeypatch.setattr(mrop, 'BROADCAST_JOIN_ROWS', 3)
+        table = [{'id' : '1', 'name' : 'Andrew'}, {'id' : '4', 'name' : 'Ivan'}]
+        on = ({'id' : str(i), 'city' : 'city' + str(i)} for i in range(10))
+        expected = run_join(table, [{'id' : str(i), 'city' : 'city' + str(i)} for i in range(10)],
+                                 ('id',), strategy, 'sort')
+        assert run_join(table, on, ('id',), strategy, 'auto') == expected
+
+    def test_keyless_join(self):
+        table = [{'word' : 'a'}, {'word' : 'b'}]
+        result = run_join(table, [{'docs_count' : 2}], tuple(), 'outer', 'auto')
+        assert result == [{'word' : 'a', 'docs_count' : 2}, {'word' : 'b', 'docs_count' : 2}]
+
+    @pytest.mark.parametrize('algorithm', ['auto', 'broadcast', 'sort'])
+    def test_empty_side(self, algorithm):
+        table = [{'word' : 'a'}]
+        assert run_join(table, [], tuple(), 'outer', algorithm) == table
+        assert run_join([], table, tuple(), 'outer', algorithm) == table
+        assert run_join(table, [], tuple(), 'inner', algorithm) == []
+
+    def test_unknown_algorithm(self):
+        with pytest.raises(ValueError):
+            run_join([], [], tuple(), 'inner', 'nested-loop')
+
+
+@pytest.mark.parametrize('extension', ['.gz', '.bz2', '.xz'])
+def test_compressed_source_and_sink(tmpdir, extension):
+    graph = mrop.ComputeGraph(source='city_ids.txt')
+    graph.finalize()
+    graph.run()
+    compressed = str(tmpdir.join('cities.txt' + extension))
+    graph.save_to_file(compressed)
+    assert mrop.detect_compression(compressed) is not None
+
+    with mrop.open_file(compressed) as file:
+        assert [ast.literal_eval(line) for line in file] == list(graph)
+
+
+def test_compressed_source_detected_by_magic(tmpdir, monkeypatch):
+    monkeypatch.setattr(mrop, 'READ_BATCH_LINES', 2)
+    lines = [{'id' : i} for i in range(7)]
+    filename = str(tmpdir.join('numbers.json'))
+    with mrop.gzip.open(filename, 'wt') as file:
+        for line in lines:
+            file.write(json.dumps(line) + '\n')
+
+    graph = mrop.ComputeGraph(source=filename)
+    graph.finalize()
+    assert graph.run() == lines
+
+
+def city_upper_mapper(line):
+    yield {**line, 'city' : line['city'].upper()}
+
+
+class TestPartitionedSource:
+    def write_shards(self, tmpdir):
+        lines = [{'id' : str(i), 'city' : 'city' + str(i)} for i in range(10)]
+        for shard in range(4):
+            with open(str(tmpdir.join('shard-{}.json'.format(shard))), 'w') as file:
+                for line in lines[shard::4]:
+                    file.write(json.dumps(line) + '\n')
+        return lines
+
+    def run_sorted(self, source, read_workers=1):
+        graph = mrop.ComputeGraph(source=source, read_workers=read_workers)
+        graph.map(city_upper_mapper)
+        graph.sort(('id',))
+        graph.finalize()
+        return graph.run()
+
+    def test_directory_glob_and_list(self, tmpdir):
+        lines = self.write_shards(tmpdir)
+        expected = sorted(({**line, 'city' : line['city'].upper()} for line in lines), key=lambda line: line['id'])
+        shards = [str(tmpdir.join('shard-{}.json'.format(shard))) for shard in range(4)]
+        assert self.run_sorted(str(tmpdir)) == expected
+        assert self.run_sorted(str(tmpdir.join('shard-*.json'))) == expected
+        assert self.run_sorted(shards) == expected
+        assert self.run_sorted(shards, read_workers=2) == expected
+
+    def test_parallel_reading_keeps_file_order(self, tmpdir):
+        self.write_shards(tmpdir)
+        sequential = mrop.ComputeGraph(source=str(tmpdir)).finalize().run()
+        parallel = mrop.ComputeGraph(source=str(tmpdir), read_workers=3).finalize().run()
+        assert parallel == sequential
+
+    def test_no_files(self, tmpdir):
+        with pytest.raises(mrop.ComputeGraphError):
+            mrop.ComputeGraph(source=str(tmpdir.join('*.json')))
+
+    def test_existing_file_with_pattern_characters(self, tmpdir):
+        tmpdir.join('data[1].json').write(json.dumps({'id' : '1'}) + '\n')
+        tmpdir.join('data1.json').write(json.dumps({'id' : '2'}) + '\n')
+        graph = mrop.ComputeGraph(source=str(tmpdir.join('data[1].json'))).finalize()
+        assert graph.run() == [{'id' : '1'}]
+
+
+def name_helper(name):
+    return name.upper()
+
+
+def helper_calling_mapper(line):
+    yield {**line, 'name' : name_helper(line['name'])}
+
+
+STOP_WORDS = {'a', 'the'}
+WORD = re.compile('[a-z]+', re.IGNORECASE)
+
+
+def set_mapper(line):
+    if line['word'] not in {'a', 'the'}:
+        yield line
+
+
+def stop_words_mapper(line):
+    if line['word'] not in STOP_WORDS:
+        yield line
+
+
+def regex_mapper(line):
+    if WORD.fullmatch(line['word']):
+        yield line
+
+
+class TestCheckpoints:
+    calls = 0
+
+    @staticmethod
+    def counting_mapper(line):
+        TestCheckpoints.calls += 1
+        yield line
+
+    def build(self, source):
+        graph = mrop.ComputeGraph(source=source)
+        graph.map(TestCheckpoints.counting_mapper)
+        graph.sort(('id',))
+        graph.join(on=cities, keys=('id',), strategy='inner')
+        graph.sort(('name',))
+        graph.finalize()
+        return graph
+
+    def test_resume_from_latest_checkpoint(self, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        TestCheckpoints.calls = 0
+        expected = self.build('citizens.txt').run(checkpoint_dir=checkpoint_dir)
+        assert TestCheckpoints.calls == len(list(names))
+        assert len(os.listdir(checkpoint_dir)) == 3
+
+        assert self.build('citizens.txt').run(checkpoint_dir=checkpoint_dir) == expected
+        assert TestCheckpoints.calls == len(list(names))
+
+    def test_changed_stage_is_recomputed(self, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        TestCheckpoints.calls = 0
+        self.build(list(names)).run(checkpoint_dir=checkpoint_dir)
+        changed = list(names) + [{'name' : 'Olga', 'id' : '3'}]
+        result = self.build(changed).run(checkpoint_dir=checkpoint_dir)
+        assert TestCheckpoints.calls == 2 * len(list(names)) + 1
+        assert 'Olga' in [line['name'] for line in result]
+
+    def test_unfinished_checkpoint_is_not_used(self, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        graph = mrop.ComputeGraph(source='citizens.txt')
+        graph.map(TestCheckpoints.counting_mapper)
+        graph.finalize()
+        rows = graph._evaluate(mrop.ExecutionContext(checkpoint_dir=checkpoint_dir))
+        next(rows)
+        rows.close()
+        assert os.listdir(checkpoint_dir) == []
+
+    def test_changed_helper_changes_fingerprint(self, monkeypatch):
+        graph = mrop.ComputeGraph(source=list(names))
+        graph.map(helper_calling_mapper)
+        graph.finalize()
+        fingerprints = graph._stage_fingerprints()
+        monkeypatch.setattr(sys.modules[__name__], 'name_helper', lambda name: name.lower())
+        changed = graph._stage_fingerprints()
+        assert changed[0] == fingerprints[0] and changed[1] != fingerprints[1]
+
+    def test_stage_computed_by_readers_is_checkpointed(self, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        shards = tmpdir.mkdir('shards')
+        for i in range(2):
+            shards.join('part-{}.txt'.format(i)).write(
+                ''.join(json.dumps({'id' : str(j)}) + '\n' for j in range(i, 10, 2)))
+        graph = mrop.ComputeGraph(source=str(shards), read_workers=2)
+        graph.map(TestCheckpoints.counting_mapper)
+        graph.finalize()
+        expected = graph.run(checkpoint_dir=checkpoint_dir)
+        assert len(os.listdir(checkpoint_dir)) == 1
+        assert graph.run(checkpoint_dir=checkpoint_dir) == expected
+
+    @pytest.mark.parametrize('mapper', [set_mapper, stop_words_mapper, regex_mapper])
+    def test_sets_and_regexes_are_fingerprinted(self, mapper, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        graph = mrop.ComputeGraph(source=[{'word' : 'a'}, {'word' : 'c'}])
+        graph.map(mapper)
+        graph.finalize()
+        fingerprints = graph._stage_fingerprints()
+        assert graph._stage_fingerprints() == fingerprints
+        graph.run(checkpoint_dir=checkpoint_dir)
+        assert len(os.listdir(checkpoint_dir)) == 1
+
+    def test_generator_source_is_not_checkpointed(self, tmpdir):
+        checkpoint_dir = str(tmpdir.join('checkpoints'))
+        with pytest.warns(UserWarning, match='not checkpointed'):
+            self.build(iter(list(names))).run(checkpoint_dir=checkpoint_dir)
+        assert not os.path.exists(checkpoint_dir)
+
+
+class TestGraceJoin:
+    def generate(self):
+        table = [{'id' : i % 30, 'name' : 'name' + str(i)} for i in range(100)]
+        on = [{'id' : i, 'city' : 'city' + str(i)} for i in range(0, 60, 2)] + [{'id' : 4, 'city' : 'twin'}]
+        return table, on
+
+    @pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+    def test_same_as_sort_join(self, strategy, monkeypatch):
+        monkeypatch.setattr(mrop, 'JOIN_MEMORY_ROWS', 2)
+        monkeypatch.setattr(mrop, 'GRACE_JOIN_BUCKETS', 3)
+        table, on = self.generate()
+        expected = run_join(table, on, ('id',), strategy, 'sort')
+        assert run_join(table, on, ('id',), strategy, 'grace') == expected
+
+    def test_auto_spills(self, monkeypatch):
+        monkeypatch.setattr(mrop, 'BROADCAST_JOIN_ROWS', 5)
+        monkeypatch.setattr(mrop, 'JOIN_MEMORY_ROWS', 20)
+        table, on = self.generate()
+        spilled = []
+        grace_join = mrop.ComputeGraph._grace_join
+        def spy(graph, *args, **kwargs):
+            spilled.append(kwargs.get('depth', 0))
+            yield from grace_join(graph, *args, **kwargs)
+        monkeypatch.setattr(mrop.ComputeGraph, '_grace_join', spy)
+        expected = run_join(table, on, ('id',), 'outer', 'sort')
+        assert run_join(iter(table), iter(on), ('id',), 'outer', 'auto') == expected
+        assert spilled == [0]
+
+    def test_keyless_join(self):
+        table = [{'word' : 'a'}, {'word' : 'b'}]
+        result = run_join(table, [{'docs_count' : 2}], tuple(), 'outer', 'grace')
+        assert result == [{'word' : 'a', 'docs_count' : 2}, {'word' : 'b', 'docs_count' : 2}]
+
+
+class TestIndexJoin:
+    def write_cities(self, tmpdir):
+        filename = str(tmpdir.join('cities.json'))
+        with open(filename, 'w') as file:
+            for line in list(cities) + [{'id' : '1', 'city' : 'Moskva'}]:
+                file.write(json.dumps(line) + '\n')
+        return filename
+
+    @pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+    def test_same_as_sort_join(self, strategy, tmpdir):
+        filename = self.write_cities(tmpdir)
+        table = list(names) + [{'name' : 'Nobody', 'id' : '7'}]
+        expected = run_join(table, list(mrop.ComputeGraph(source=filename).finalize()), ('id',), strategy, 'sort')
+        assert run_join(table, mrop.build_index(filename, ('id',)), ('id',), strategy, 'auto') == expected
+        graph = mrop.ComputeGraph(source=filename).finalize()
+        assert run_join(table, graph, ('id',), strategy, 'index') == expected
+
+    def test_sidecar_is_reused_until_file_changes(self, tmpdir, monkeypatch):
+        filename = self.write_cities(tmpdir)
+        index = mrop.build_index(filename, ('id',))
+        assert os.path.exists(index.index_filename)
+        assert index.is_valid()
+
+        monkeypatch.setattr(mrop.JsonLinesIndex, 'build', None)
+        assert mrop.build_index(filename, ('id',)).offsets == index.offsets
+        monkeypatch.undo()
+
+        with open(filename, 'a') as file:
+            file.write(json.dumps({'id' : '4', 'city' : 'Omsk'}) + '\n')
+        assert not index.is_valid()
+        assert ('4',) in mrop.build_index(filename, ('id',)).offsets
+
+    def test_auto_uses_existing_index(self, tmpdir, monkeypatch):
+        filename = self.write_cities(tmpdir)
+        graph = mrop.ComputeGraph(source=filename).finalize()
+        assert run_join(list(names), graph, ('id',), 'inner', 'auto') == run_join(
+            list(names), graph, ('id',), 'inner', 'sort')
+
+        mrop.build_index(filename, ('id',))
+        used = []
+        index_join = mrop.ComputeGraph._index_join
+        def spy(graph, table, index, *args):
+            used.append(index.filename)
+            yield from index_join(graph, table, index, *args)
+        monkeypatch.setattr(mrop.ComputeGraph, '_index_join', spy)
+        assert len(run_join(list(names), graph, ('id',), 'inner', 'auto')) == 5
+        assert used == [filename]
+
+
+def doubling_mapper(line):
+    yield {**line, 'double' : 2 * line['value']}
+
+
+class TestReentrantExecution:
+    def build(self):
+        counted = mrop.ComputeGraph(source=[])
+        counted.map(doubling_mapper)
+        counted.finalize()
+
+        graph = mrop.ComputeGraph(source=counted)
+        graph.join(on=counted, keys=('value',), strategy='inner')
+        graph.sort(('value',))
+        graph.finalize()
+        return counted, graph
+
+    def test_graph_is_not_changed_by_evaluation(self):
+        counted, graph = self.build()
+        dependences = list(graph.dependences)
+        counted.change_source([{'value' : 1}])
+        assert graph.evaluate() == graph.evaluate() == [{'value' : 1, 'double' : 2}]
+        assert graph.dependences == dependences
+        assert graph.result is None and counted.result is None
+
+    def test_shared_dependency_is_evaluated_once(self, monkeypatch):
+        counted, graph = self.build()
+        counted.change_source([{'value' : 1}, {'value' : 2}])
+        calls = []
+        def counting_mapper(line):
+            calls.append(line)
+            yield from doubling_mapper(line)
+        counted.operations[0] = ('_map', counting_mapper)
+        graph.evaluate()
+        assert len(calls) == 2
+
+    def test_evaluate_with_another_source(self):
+        graph = mrop.ComputeGraph(source=[{'value' : 1}])
+        graph.map(doubling_mapper)
+        graph.finalize()
+        assert graph.evaluate(source=[{'value' : 5}]) == [{'value' : 5, 'double' : 10}]
+        assert graph.evaluate() == [{'value' : 1, 'double' : 2}]
+
+    @pytest.mark.parametrize('processes', [False, True])
+    def test_evaluate_many(self, processes):
+        graph = mrop.ComputeGraph(source=[])
+        graph.map(doubling_mapper)
+        graph.sort(('double',))
+        graph.finalize()
+        sources = [[{'value' : v} for v in range(n, 0, -1)] for n in range(20)]
+        results = graph.evaluate_many(sources, n_workers=4, processes=processes)
+        assert results == [[{'value' : v, 'double' : 2 * v} for v in range(1, n + 1)] for n in range(20)]
+
+
+class TestColumnar:
+    table = [
+        {'id' : 1, 'city' : 'Moscow', 'speed' : 1.5, 'busy' : True, 'tags' : ['a'], 'name' : 'x' * 3},
+        {'id' : 2, 'city' : 'Moscow', 'speed' : None, 'busy' : False, 'tags' : [], 'name' : 'y'},
+        {'id' : 3, 'city' : 'Moscow', 'busy' : False, 'tags' : None, 'name' : 'Юрий'},
+        {'id' : 2 ** 70, 'city' : 'Kazan', 'speed' : -0.5, 'busy' : True, 'tags' : {'b' : 1}, 'name' : ''},
+    ]
+
+    def test_round_trip(self, tmpdir):
+        dirname = str(tmpdir.join('table'))
+        graph = mrop.ComputeGraph(source=self.table).finalize()
+        graph.run()
+        graph.save_columnar(dirname)
+        types = {column['name'] : column['type'] for column in mrop.ColumnarTable(dirname).schema['columns']}
+        assert types == {'id' : 'json', 'city' : 'dictionary', 'speed' : 'float64', 'busy' : 'bool',
+                         'tags' : 'json', 'name' : 'string'}
+        assert list(mrop.ColumnarTable(dirname)) == self.table
+        assert mrop.ComputeGraph(source=dirname).finalize().run() == self.table
+
+    def test_projection(self, tmpdir, monkeypatch):
+        dirname = str(tmpdir.join('table'))
+        mrop.write_columnar(self.table[:3], dirname)
+        opened = []
+        view = mrop._MappedFiles.view
+        def spy(files, filename, *args):
+            opened.append(os.path.basename(filename))
+            return view(files, filename, *args)
+        monkeypatch.setattr(mrop._MappedFiles, 'view', spy)
+
+        graph = mrop.ComputeGraph(source=mrop.ColumnarTable(dirname, columns=('speed', 'id')))
+        graph.sort(('id',))
+        graph.finalize()
+        assert graph.run() == [{'speed' : 1.5, 'id' : 1}, {'speed' : None, 'id' : 2}, {'id' : 3}]
+        assert sorted(opened) == ['0.presence', '0.values', '2.presence', '2.values']
+
+    def test_empty_and_unknown_columns(self, tmpdir):
+        dirname = str(tmpdir.join('table'))
+        mrop.write_columnar([], dirname)
+        assert list(mrop.ColumnarTable(dirname)) == []
+        with pytest.raises(mrop.ComputeGraphError):
+            mrop.ColumnarTable(dirname, columns=('id',))
+
+
+@pytest.mark.parametrize('keys', [('a',), ('b', 'a'), tuple()])
+def test_parallel_sort(keys, monkeypatch):
+    monkeypatch.setattr(mrop, 'PARALLEL_SORT_MIN_LINES', 10)
+    table = [{'a' : (i * 7919) % 101, 'b' : i % 3, 'i' : i} for i in range(300)]
+    graph = mrop.ComputeGraph(source=table)
+    graph.sort(keys, n_workers=3)
+    graph.finalize()
+    result = graph.run()
+    assert result == sorted(table, key=lambda line: tuple(line[k] for k in keys))
+    assert all(line is table[line['i']] for line in result)
+
+
+class TestStatistics:
+    def build(self, table, on):
+        graph = mrop.ComputeGraph(source=table)
+        graph.map(doubling_mapper)
+        graph.join(on=on, keys=('value',), strategy='left')
+        graph.finalize()
+        return graph
+
+    def test_statistics_are_collected_and_saved(self, tmpdir):
+        filename = str(tmpdir.join('statistics.json'))
+        on = mrop.ComputeGraph(source=[{'value' : v % 10, 'name' : str(v)} for v in range(50)]).finalize()
+        graph = self.build([{'value' : v} for v in range(1000)], on)
+        graph.run(statistics=filename)
+
+        statistics = mrop.Statistics(filename)
+        fingerprints = graph._stage_fingerprints()
+        assert statistics.get(fingerprints[0])['rows'] == 1000
+        assert statistics.get(fingerprints[1])['rows'] == 1000
+        assert statistics.get(fingerprints[1])['row_bytes'] > 0
+        assert 800 < statistics.distinct(fingerprints[1], ('value',)) < 1200
+        assert statistics.get(fingerprints[2])['rows'] == 1000 - 10 + 50
+        assert statistics.get(on._stage_fingerprints()[0])['rows'] == 50
+
+    def test_next_run_is_planned_by_statistics(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(mrop, 'BROADCAST_JOIN_ROWS', 5)
+        filename = str(tmpdir.join('statistics.json'))
+        table = [{'value' : v} for v in range(20)]
+        on = mrop.ComputeGraph(source=[{'value' : v % 10, 'name' : str(v)} for v in range(200)]).finalize()
+        expected = self.build(table, on).evaluate(statistics=filename)
+
+        choices = []
+        choose_join = mrop.ComputeGraph._choose_join
+        def spy(graph, *args):
+            choices.append(choose_join(graph, *args))
+            return choices[-1]
+        monkeypatch.setattr(mrop.ComputeGraph, '_choose_join', spy)
+        result = self.build(table, on).evaluate(statistics=filename)
+        assert choices == [('hash', 'table', None)]
+        key = lambda line: sorted((k, str(v)) for k, v in line.items())
+        assert sorted(result, key=key) == sorted(expected, key=key)
+
+    def test_unhashable_keys(self, tmpdir):
+        filename = str(tmpdir.join('statistics.json'))
+        table = [{'tags' : [v % 7, 'tag']} for v in range(100)]
+        graph = mrop.ComputeGraph(source=table)
+        graph.sort(('tags',))
+        graph.finalize()
+        assert graph.run(statistics=filename) == sorted(table, key=lambda line: line['tags'])
+        assert mrop.Statistics(filename).distinct(graph._stage_fingerprints()[0], ('tags',)) == 7
+
+    def test_cost_model(self, monkeypatch):
+        monkeypatch.setattr(mrop, 'BROADCAST_JOIN_ROWS', 10)
+        monkeypatch.setattr(mrop, 'JOIN_MEMORY_ROWS', 1000)
+        choose = mrop.ComputeGraph()._choose_join
+        small, medium, large = {'rows' : 5}, {'rows' : 500, 'row_bytes' : 100}, {'rows' : 5000, 'row_bytes' : 100}
+        assert choose(large, small, False, False) == ('broadcast', 'on', None)
+        assert choose(small, large, False, False) == ('broadcast', 'table', None)
+        assert choose(large, medium, False, False) == ('hash', 'on', None)
+        assert choose(medium, medium, True, True) == ('sort', 'on', None)
+        assert choose(large, large, False, False) == ('grace', 'on', 16)
+        assert choose(large, large, False, False, 4) == ('grace', 'on', 4)
+
+
+class TestBloomJoin:
+    def build(self, table, on, strategy, bloom, algorithm='sort'):
+        graph = mrop.ComputeGraph(source=table)
+        graph.map(doubling_mapper)
+        graph.sort(('value',))
+        graph.join(on=on, keys=('value',), strategy=strategy, algorithm=algorithm, bloom=bloom)
+        graph.finalize()
+        return graph
+
+    @pytest.mark.parametrize('algorithm', ['sort', 'hash'])
+    @pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+    @pytest.mark.parametrize('table_values, on_values', [(range(200), range(0, 400, 7)),
+                                                         (range(50), range(1000, 1010))])
+    def test_same_as_without_filter(self, strategy, algorithm, table_values, on_values):
+        table = [{'value' : v} for v in table_values]
+        on = [{'value' : v, 'name' : str(v)} for v in on_values]
+        key = lambda line: sorted((k, str(v)) for k, v in line.items())
+        expected = self.build(table, on, strategy, False, algorithm).evaluate()
+        result = self.build(table, on, strategy, True, algorithm).evaluate()
+        assert sorted(result, key=key) == sorted(expected, key=key)
+
+    def test_filter_is_applied_below_sort(self, monkeypatch):
+        sorted_lines = []
+        sort = mrop.ComputeGraph._sort
+        def spy(graph, context, table, *args):
+            lines = list(table)
+            sorted_lines.append(len(lines))
+            return sort(graph, context, lines, *args)
+        monkeypatch.setattr(mrop.ComputeGraph, '_sort', spy)
+        table = [{'value' : v} for v in range(1000)]
+        on = mrop.ComputeGraph(source=[{'value' : v, 'name' : str(v)} for v in range(0, 2000, 100)]).finalize()
+        result = self.build(table, on, 'inner', True).evaluate()
+        assert sorted(line['value'] for line in result) == list(range(0, 1000, 100))
+        assert sorted_lines[0] < 100
+
+    def test_graph_on_is_spilled(self, monkeypatch):
+        spilled = []
+        spill = mrop._spill
+        def spy(table, *args):
+            spilled.append(args[-1])
+            return spill(table, *args)
+        monkeypatch.setattr(mrop, '_spill', spy)
+        table = [{'value' : v} for v in range(200)]
+        on = [{'value' : v, 'name' : str(v)} for v in range(0, 400, 7)]
+        expected = self.build(table, on, 'inner', True).evaluate()
+        assert spilled == []
+        graph_on = mrop.ComputeGraph(source=iter(on)).finalize()
+        assert self.build(table, graph_on, 'inner', True).evaluate() == expected
+        assert spilled == ['on']
+
+    def test_filter_is_skipped_for_larger_on(self, tmpdir, monkeypatch):
+        filename = str(tmpdir.join('statistics.json'))
+        table = [{'value' : v} for v in range(100)]
+        on = mrop.ComputeGraph(source=[{'value' : v, 'name' : str(v)} for v in range(0, 1000, 3)]).finalize()
+        expected = self.build(table, on, 'inner', True).evaluate(statistics=filename)
+        filtered = []
+        monkeypatch.setattr(mrop._SemiJoin, 'filter', lambda semi_join, table: filtered.append(1) or table)
+        assert self.build(table, on, 'inner', True).evaluate(statistics=filename) == expected
+        assert filtered == []
+
+    def test_bloom_filter(self):
+        bloom = mrop.BloomFilter(1000)
+        for value in range(1000):
+            bloom.add(value)
+        assert all(value in bloom for value in range(1000))
+        assert sum(value in bloom for value in range(1000, 11000)) < 300
+
+
+class TestDistinct:
+    table = [{'word' : word, 'doc' : doc} for doc in range(5) for word in 'abcabdae'] + [{'word' : 'z', 'doc' : [1]}]
+
+    def distinct(self, table, **kwargs):
+        graph = mrop.ComputeGraph(source=table)
+        graph.distinct(**kwargs)
+        graph.finalize()
+        return graph.evaluate()
+
+    def test_first_and_last(self):
+        first = self.distinct(self.table, keys=('word',))
+        assert first == [{'word' : w, 'doc' : 0} for w in 'abcde'] + [{'word' : 'z', 'doc' : [1]}]
+        last = self.distinct(self.table, keys=('word',), keep='last')
+        assert last == [{'word' : w, 'doc' : 4} for w in 'cbdae'] + [{'word' : 'z', 'doc' : [1]}]
+
+    def test_whole_rows(self):
+        expected = []
+        for line in self.table:
+            if line not in expected:
+                expected.append(line)
+        assert self.distinct(self.table + self.table) == expected
+
+    @pytest.mark.parametrize('keep', ['first', 'last'])
+    def test_spill_to_disk(self, keep):
+        table = [{'key' : (i * 7919) % 500, 'i' : i} for i in range(3000)]
+        result = self.distinct(table, keys=('key',), keep=keep, memory_rows=50)
+        expected = self.distinct(table, keys=('key',), keep=keep)
+        assert len(result) == 500
+        assert sorted(result, key=lambda line: line['key']) == sorted(expected, key=lambda line: line['key'])
+
+    @pytest.mark.parametrize('keep', ['first', 'last'])
+    def test_unhashable_keys(self, keep):
+        table = [{'t' : [1], 'i' : 0}, {'t' : '[1]', 'i' : 1}, {'t' : [1], 'i' : 2}, {'t' : [2], 'i' : 3}]
+        result = self.distinct(table, keys=('t',), keep=keep)
+        assert sorted(line['i'] for line in result) == ([0, 1, 3] if keep == 'first' else [1, 2, 3])
+
+    def test_unknown_keep(self):
+        with pytest.raises(ValueError):
+            mrop.ComputeGraph(source=[]).distinct(keep='middle')
+
+
+class TestPipeline:
+    def build(self):
+        on = mrop.ComputeGraph(source=[{'value' : v, 'name' : str(v)} for v in range(0, 3000, 3)])
+        on.map(doubling_mapper)
+        on.finalize()
+        graph = mrop.ComputeGraph(source=[{'value' : v % 1000} for v in range(3000)])
+        graph.map(doubling_mapper)
+        graph.sort(('value',))
+        graph.join(on=on, keys=('value',), strategy='left')
+        graph.distinct()
+        graph.finalize()
+        return graph
+
+    def test_same_result(self):
+        pipeline = mrop.Pipeline(batch_lines=16, queue_batches=2)
+        assert self.build().evaluate(pipeline=pipeline) == self.build().evaluate()
+        report = pipeline.report()
+        assert len(report) == 2 + 5
+        assert [stage['lines'] for stage in report[:3]] == [3000, 3000, 3000]
+        assert all(0 <= stage['occupancy'] <= 1 for stage in report)
+
+    def test_chosen_stages(self):
+        pipeline = mrop.Pipeline(stages=[0])
+        self.build().evaluate(pipeline=pipeline)
+        assert [stage['lines'] for stage in pipeline.report()] == [3000, 1000]
+
+    def test_backpressure(self):
+        produced = []
+        def source(context):
+            for v in range(1000):
+                produced.append(v)
+                yield {'value' : v}
+        graph = mrop.ComputeGraph(source=[]).finalize()
+        pipe = mrop.Pipeline(batch_lines=10, queue_batches=2).pipe(graph, 0, source(None))
+        rows = iter(pipe)
+        next(rows)
+        pipe.thread.join(0.2)
+        assert len(produced) <= 10 * 4
+        rows.close()
+        pipe.thread.join(1)
+        assert not pipe.thread.is_alive()
+
+    def test_error_is_raised_in_consumer(self):
+        graph = mrop.ComputeGraph(source=[{'value' : 1}, {}])
+        graph.map(doubling_mapper)
+        graph.finalize()
+        with pytest.raises(KeyError):
+            graph.evaluate(pipeline=True)
+
+
+def upper_city_mapper(line):
+    TestMemoize.calls += 1
+    yield {'id' : line['id'], 'city' : line['city'].upper(), 'letters' : list(line['city'])}
+
+
+class TestMemoize:
+    calls = 0
+    table = [{'id' : i, 'city' : ['Moscow', 'Paris', 'Rome'][i % 3], 'extra' : i} for i in range(30)]
+
+    def run(self, memoize):
+        TestMemoize.calls = 0
+        graph = mrop.ComputeGraph(source=self.table)
+        graph.map(upper_city_mapper, memoize=memoize)
+        graph.finalize()
+        return graph.evaluate()
+
+    def test_same_result_with_fewer_calls(self):
+        memoizer = mrop.Memoizer(('city',), passthrough=('id',))
+        expected = self.run(None)
+        assert self.calls == 30
+        assert self.run(memoizer) == expected
+        assert self.calls == 3
+        assert memoizer.hit_ratio() == 27 / 30
+
+    def test_whole_rows(self):
+        assert self.run(True) == self.run(None)
+        assert self.calls == 30
+
+    def test_constant_output_colliding_with_input(self):
+        def mapper(line):
+            yield {'city' : line['city'].upper(), 'visited' : False}
+        table = [{'city' : 'a', 'visited' : False}, {'city' : 'a', 'visited' : True}]
+        graph = mrop.ComputeGraph(source=table)
+        graph.map(mapper, memoize=('city',))
+        graph.finalize()
+        assert graph.evaluate() == [{'city' : 'A', 'visited' : False}] * 2
+
+    def test_unhashable_fields(self):
+        memoizer = mrop.Memoizer(('tags',))
+        mapper = lambda line: [{'n' : len(line['tags'])}]
+        assert [memoizer.map(mapper, {'tags' : tags}) for tags in ([1, 2], [1, 2], [3])] == [
+            [{'n' : 2}], [{'n' : 2}], [{'n' : 1}]]
+        assert memoizer.hits == 1
+
+    @pytest.mark.parametrize('policy, kept', [('lru', {'b', 'c'}), ('lfu', {'a', 'c'})])
+    def test_eviction(self, policy, kept):
+        memoizer = mrop.Memoizer(size=2, policy=policy)
+        mapper = lambda line: [line]
+        for key in 'aabc':
+            memoizer.map(mapper, {'key' : key})
+        assert {json.loads(key)['key'] for key in memoizer.entries} == kept
+
+    def test_persistence(self, tmpdir):
+        filename = str(tmpdir.join('cache.pickle'))
+        self.run(mrop.Memoizer(('city',), filename=filename, passthrough=('id',)))
+        memoizer = mrop.Memoizer(('city',), filename=filename, passthrough=('id',))
+        self.run(memoizer)
+        assert self.calls == 0
+        assert memoizer.hit_ratio() == 1
+
+    def test_changed_mapper_discards_saved_outputs(self, tmpdir):
+        filename = str(tmpdir.join('cache.pickle'))
+        def run(mapper):
+            graph = mrop.ComputeGraph(source=[{'w' : 'hi'}])
+            graph.map(mapper, memoize=mrop.Memoizer(('w',), filename=filename))
+            graph.finalize()
+            return graph.evaluate()
+        assert run(lambda line: [{'w' : line['w'].upper()}]) == [{'w' : 'HI'}]
+        assert run(lambda line: [{'w' : line['w'].lower() + '!'}]) == [{'w' : 'hi!'}]
+
+
+def counting_words_mapper(line):
+    TestSharedPrefixes.calls += 1
+    for word in line['text'].split():
+        yield {'doc_id' : line['doc_id'], 'word' : word}
+
+
+def count_words_reducer(table):
+    yield {'word' : table[0]['word'], 'count' : len(table)}
+
+
+class TestSharedPrefixes:
+    calls = 0
+    texts = [{'doc_id' : 1, 'text' : 'a b a'}, {'doc_id' : 2, 'text' : 'b c'}, {'doc_id' : 3, 'text' : 'c c a'}]
+
+    def words(self, *sort_keys):
+        graph = mrop.ComputeGraph(source=self.texts)
+        graph.map(counting_words_mapper)
+        for keys in sort_keys:
+            graph.sort(keys)
+        return graph
+
+    def build(self):
+        counts = self.words(('word',)).reduce(count_words_reducer, ('word',)).finalize()
+        docs = self.words(('word',)).distinct(('word', 'doc_id')).finalize()
+        graph = self.words(('word',), ('doc_id',))
+        graph.join(on=counts, keys=('word',))
+        graph.join(on=docs, keys=('word', 'doc_id'))
+        return graph.finalize()
+
+    def test_prefix_is_computed_once(self):
+        key = lambda line: sorted(line.items())
+        TestSharedPrefixes.calls = 0
+        graph = self.build()
+        context = mrop.ExecutionContext()
+        expected = sorted(graph._evaluate(context), key=key)
+        assert self.calls == 9
+
+        TestSharedPrefixes.calls = 0
+        context = mrop.ExecutionContext(share_prefixes=True)
+        assert sorted(graph._evaluate(context), key=key) == expected
+        assert self.calls == 3
+        assert len({id(prefix) for prefix, _ in context.prefixes.values()}) == 1
+        assert not context.results
+
+    def test_fingerprints_of_graphs_are_computed_once(self, monkeypatch):
+        graph = self.build()
+        computed = Counter()
+        stage_fingerprints = mrop.ComputeGraph._stage_fingerprints
+
+        def counting_stage_fingerprints(graph, *args):
+            computed[graph] += 1
+            return stage_fingerprints(graph, *args)
+
+        monkeypatch.setattr(mrop.ComputeGraph, '_stage_fingerprints', counting_stage_fingerprints)
+        graph.evaluate(share_prefixes=True)
+        assert computed and set(computed.values()) == {1}
+
+
+def sum_folder(line, state):
+    return {'count' : state['count'] + 1, 'total' : state['total'] + line['value']}
+
+
+def sum_merge(left, right):
+    return {'count' : left['count'] + right['count'], 'total' : left['total'] + right['total']}
+
+
+def concat_folder(line, state):
+    return {'values' : state['values'] + [line['value']]}
+
+
+def concat_merge(left, right):
+    return {'values' : left['values'] + right['values']}
+
+
+class TestParallelFold:
+    def fold(self, source, folder, initial, merge, n_workers=1, read_workers=1):
+        graph = mrop.ComputeGraph(source=source, read_workers=read_workers)
+        graph.fold(folder, initial, merge=merge, n_workers=n_workers)
+        graph.finalize()
+        return graph.evaluate()
+
+    def test_chunks_in_processes(self, monkeypatch):
+        monkeypatch.setattr(mrop, 'PARALLEL_FOLD_CHUNK_LINES', 7)
+        table = [{'value' : v} for v in range(100)]
+        initial = {'count' : 0, 'total' : 0}
+        assert self.fold(table, sum_folder, initial, sum_merge, n_workers=3) == [{'count' : 100, 'total' : 4950}]
+        assert self.fold(table, concat_folder, {'values' : []}, concat_merge, n_workers=3) == \
+            [{'values' : list(range(100))}]
+        assert self.fold([], sum_folder, initial, sum_merge, n_workers=3) == [initial]
+
+    def test_partitions_in_reader_processes(self, tmpdir):
+        for shard in range(5):
+            with open(str(tmpdir.join('part-{}.json'.format(shard))), 'w') as file:
+                for v in range(shard * 10, shard * 10 + 10):
+                    file.write(json.dumps({'value' : v}) + '\n')
+        result = self.fold(str(tmpdir), concat_folder, {'values' : []}, concat_merge, read_workers=2)
+        assert result == [{'values' : list(range(50))}]
+
+    def test_tree_merge_order(self):
+        states = [{'values' : [i]} for i in range(11)]
+        assert mrop._tree_merge(states, concat_merge, None) == {'values' : list(range(11))}
+
+
+def group_reducer(table):
+    yield {'value' : table[0]['value'], 'lines' : [dict(line) for line in table]}
+
+
+class TestTracing:
+    def build(self, reducer=group_reducer, rows=2000):
+        shared = mrop.ComputeGraph(source=[{'value' : v % 50, 'payload' : 'x' * 100} for v in range(rows)])
+        shared.map(doubling_mapper)
+        shared.finalize()
+        graph = mrop.ComputeGraph(source=shared)
+        graph.sort(('value',))
+        graph.reduce(reducer, ('value',))
+        graph.join(on=shared, keys=('value',), strategy='inner', algorithm='grace')
+        graph.finalize()
+        return graph
+
+    def test_spans_and_events(self, tmpdir):
+        filename = str(tmpdir.join('trace.json'))
+        expected = self.build().evaluate()
+        assert self.build().evaluate(trace=filename) == expected
+        with open(filename) as file:
+            events = json.load(file)['traceEvents']
+        spans = Counter((event['name'], event['ph']) for event in events if event['ph'] in 'be')
+        assert spans[('sort 1', 'b')] == spans[('sort 1', 'e')] == 1
+        assert spans[('join 3', 'e')] == 1
+        assert sum(count for (name, ph), count in spans.items() if name.startswith('graph') and ph == 'b') == 2
+        names = {event['name'] for event in events if event['ph'] == 'i'}
+        assert {'result kept', 'result reused', 'spill'} <= names
+        ends = {event['name'] : event['args']['rows'] for event in events if event['ph'] == 'e'}
+        assert ends['sort 1'] == 2000 and ends['reduce 2'] == 50
+
+    def test_memory_attribution(self):
+        tracer = mrop.Tracer(memory=True, memory_interval=1000)
+        def sampling_reducer(table):
+            if table[0]['value'] == 25:
+                tracer.sample_memory()
+            yield from group_reducer(table)
+        self.build(sampling_reducer, rows=200).evaluate(trace=tracer)
+        samples = [event['args'] for event in tracer.chrome_trace()['traceEvents'] if event['ph'] == 'C']
+        assert len(samples) == 3
+        assert samples[1]['sort'] > 0 and samples[1]['kept results'] > 0
+        assert not mrop.tracemalloc.is_tracing()